@@ -0,0 +1,189 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+# ================= RATE LIMITING & FAIR SCHEDULING =================
+# Shared by bot.py (Gemini) and groq_chatbot.py (Groq) for every AI entry point.
+
+
+class AIBusyError(Exception):
+    """Raised when the AI queue is full and a request is rejected."""
+
+
+class RateLimited(Exception):
+    """Raised when a user or guild is over its AI request budget."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Classic token bucket: `capacity` burst, refilled at `rate` tokens per second."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float = 1.0) -> float:
+        """Seconds until `cost` tokens are available (0 = available now)."""
+        self.refill()
+        if self.tokens >= cost:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float = 1.0):
+        self.tokens -= cost
+
+
+class RateLimiter:
+    """Per-user and per-guild token buckets for AI requests."""
+
+    def __init__(self, user_rate: float, user_burst: float, guild_rate: float, guild_burst: float):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self._users = {}   # user_id -> TokenBucket
+        self._guilds = {}  # guild_id -> TokenBucket
+
+    def check(self, user_id: int, guild_id: int):
+        """Consume one request for the user and guild, or raise RateLimited."""
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = TokenBucket(self.guild_rate, self.guild_burst)
+
+        retry_after = max(user.wait_time(), guild.wait_time())
+        if retry_after > 0:
+            raise RateLimited(retry_after)
+        user.take()
+        guild.take()
+
+    def prune(self):
+        """Forget buckets that have refilled completely; they behave like new ones."""
+        for buckets in (self._users, self._guilds):
+            for key in [k for k, bucket in buckets.items() if bucket.wait_time(bucket.capacity) == 0]:
+                del buckets[key]
+
+
+class FairScheduler:
+    """Concurrency-capped executor with weighted fair queuing across guilds.
+
+    At most `max_concurrency` jobs run at once. Waiting jobs are ordered by
+    a virtual finish time per guild, so a guild that floods the queue only
+    delays itself; `weights` gives some guilds a larger share. Up to
+    `max_queue` jobs may wait, anything beyond that raises AIBusyError.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, timeout: float, weights: dict = None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.weights = weights or {}
+        self.active = 0
+        self.virtual_time = 0.0
+        self._heap = []         # (finish_tag, seq, future)
+        self._last_finish = {}  # guild_id -> finish tag of its latest queued job
+        self._seq = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._heap)
+
+    def queue_position(self) -> int:
+        """Queue position a new request would get (0 = runs immediately)."""
+        if self.active < self.max_concurrency and not self._heap:
+            return 0
+        return len(self._heap) + 1
+
+    def is_full(self) -> bool:
+        return self.active >= self.max_concurrency and len(self._heap) >= self.max_queue
+
+    async def run(self, guild_id: int, func, *args, **kwargs):
+        """Await `func(*args, **kwargs)` once the guild's turn comes up."""
+        await self._acquire(guild_id)
+        try:
+            return await asyncio.wait_for(func(*args, **kwargs), timeout=self.timeout)
+        finally:
+            self._release()
+
+    async def run_blocking(self, guild_id: int, func, *args):
+        """Run blocking `func(*args)` on a worker thread once the guild's turn comes up.
+
+        A thread can't be cancelled, so on timeout the caller gets
+        TimeoutError but the slot stays taken until the thread returns;
+        otherwise timeouts would let more than `max_concurrency` run.
+        """
+        await self._acquire(guild_id)
+        future = asyncio.get_running_loop().run_in_executor(None, func, *args)
+        future.add_done_callback(self._thread_done)
+        return await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+
+    def _thread_done(self, future):
+        if not future.cancelled():
+            future.exception()  # Already reported to the caller, or nobody is waiting after a timeout
+        self._release()
+
+    async def _acquire(self, guild_id: int):
+        if self.is_full():
+            raise AIBusyError()
+        if self.active < self.max_concurrency and not self._heap:
+            self.active += 1
+        else:
+            await self._wait_turn(guild_id)
+
+    async def _wait_turn(self, guild_id: int):
+        start = max(self.virtual_time, self._last_finish.get(guild_id, 0.0))
+        finish = start + 1.0 / self.weights.get(guild_id, 1.0)
+        self._last_finish[guild_id] = finish
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (finish, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # The slot was handed over just before we were cancelled
+            else:
+                future.cancel()  # Skipped lazily by _release
+            raise
+
+    def _release(self):
+        self.active -= 1
+        while self._heap:
+            finish, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            self.virtual_time = finish
+            self.active += 1
+            future.set_result(None)
+            break
+
+    def prune(self):
+        """Forget guilds whose last job is already behind the virtual clock."""
+        for guild_id in [g for g, finish in self._last_finish.items() if finish <= self.virtual_time]:
+            del self._last_finish[guild_id]
+
+
+def parse_weights(value: str) -> dict:
+    """Parse "guild_id:weight,guild_id:weight" into a dict."""
+    weights = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        guild_id, _, weight = item.partition(":")
+        weights[int(guild_id)] = float(weight or 1)
+    return weights
@@ -1,5 +1,5 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import ui, app_commands
 from dotenv import load_dotenv
 import google.generativeai as genai
@@ -7,8 +7,20 @@ import os
 import socket
 import datetime
 import asyncio
+import bisect
+import time
 import random
 import re
+import json
+import hashlib
+import heapq
+import io
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from typing import Optional
+from collections import OrderedDict, deque
+from ai_scheduler import AIBusyError, FairScheduler, RateLimited, RateLimiter, parse_weights
 
 # ================= LOAD ENV =================
 load_dotenv()
@@ -42,14 +54,15 @@ GEMINI_MODELS = {
     }
 }
 
-# Current settings
-current_gemini_model = "flash"
+# Default model for guilds that haven't picked one
+DEFAULT_GEMINI_MODEL = os.getenv("DEFAULT_GEMINI_MODEL", "flash").lower()
+if DEFAULT_GEMINI_MODEL not in GEMINI_MODELS:
+    # Also accept a full model name such as "gemini-2.0-flash"
+    DEFAULT_GEMINI_MODEL = next(
+        (key for key, info in GEMINI_MODELS.items() if info["name"] == DEFAULT_GEMINI_MODEL), "flash"
+    )
 
-def create_model(model_key: str):
-    """Create a Gemini model with system instruction."""
-    return genai.GenerativeModel(
-        model_name=GEMINI_MODELS[model_key]["name"],
-        system_instruction="""
+SYSTEM_INSTRUCTION = """
         Kamu adalah chatbot Discord berbahasa Indonesia.
         Peran kamu:
         - Menjawab pertanyaan seputar IT, pemrograman, dan teknologi
@@ -57,32 +70,1133 @@ def create_model(model_key: str):
         - Gunakan bahasa sopan dan ramah
         - Jika tidak tahu, katakan tidak tahu
         """
+
+def create_model(model_key: str):
+    """Create a Gemini model with system instruction."""
+    return genai.GenerativeModel(
+        model_name=GEMINI_MODELS[model_key]["name"],
+        system_instruction=SYSTEM_INSTRUCTION
     )
 
-model = create_model(current_gemini_model)
+# ================= DATABASE =================
+DB_PATH = os.getenv("BOT_DB_PATH", "bot_data.db")
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "5"))
+
+db = sqlite3.connect(DB_PATH, check_same_thread=False)
+db.execute("PRAGMA journal_mode=WAL")
+db.execute("PRAGMA synchronous=NORMAL")
+
+# All SQLite work runs on one thread so the event loop never waits on disk
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+async def run_db(func, *args):
+    """Run a blocking SQLite call on the database thread."""
+    return await asyncio.get_running_loop().run_in_executor(db_executor, func, *args)
+
+class WriteBehind:
+    """Buffer row upserts and deletes in memory and commit them in batches.
+
+    `put` and `delete` only touch a dict, `flush` writes everything pending
+    in a single transaction on the database thread.
+    """
+
+    def __init__(self, upsert_sql: str, delete_sql: str):
+        self.upsert_sql = upsert_sql
+        self.delete_sql = delete_sql
+        self.pending = {}  # key -> row tuple, or None for a delete
+
+    def put(self, key, row: tuple):
+        self.pending[key] = row
+
+    def delete(self, key):
+        self.pending[key] = None
+
+    def _write(self, batch: dict):
+        upserts = [row for row in batch.values() if row is not None]
+        deletes = [key if isinstance(key, tuple) else (key,) for key, row in batch.items() if row is None]
+        with db:
+            if upserts:
+                db.executemany(self.upsert_sql, upserts)
+            if deletes:
+                db.executemany(self.delete_sql, deletes)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            await run_db(self._write, batch)
+        except Exception as e:
+            print(f"DB flush error: {e}")
+            # Retry on the next flush without clobbering newer writes
+            for key, row in batch.items():
+                self.pending.setdefault(key, row)
+
+write_behind_queues = []
+
+async def flush_all_write_behind():
+    for queue in write_behind_queues:
+        await queue.flush()
+
+@tasks.loop(seconds=DB_FLUSH_INTERVAL)
+async def flush_write_behind():
+    await flush_all_write_behind()
+
+# ================= AI MODEL REGISTRY (PER GUILD) =================
+class ModelRegistry:
+    """Build each GenerativeModel once and reuse it across guilds and sessions."""
+
+    def __init__(self):
+        self._models = {}
+
+    def get(self, model_key: str):
+        model = self._models.get(model_key)
+        if model is None:
+            model = self._models[model_key] = create_model(model_key)
+        return model
+
+model_registry = ModelRegistry()
+
+db.execute(
+    "CREATE TABLE IF NOT EXISTS guild_settings ("
+    "guild_id INTEGER PRIMARY KEY, ai_model TEXT NOT NULL)"
+)
+guild_settings_writer = WriteBehind(
+    "INSERT OR REPLACE INTO guild_settings (guild_id, ai_model) VALUES (?, ?)",
+    "DELETE FROM guild_settings WHERE guild_id = ?"
+)
+write_behind_queues.append(guild_settings_writer)
+
+# One row per guild, small enough to load up front
+guild_models = {
+    guild_id: model_key
+    for guild_id, model_key in db.execute("SELECT guild_id, ai_model FROM guild_settings")
+    if model_key in GEMINI_MODELS
+}
+
+# DMs have no guild to share a setting with, so each DM user picks their own
+db.execute(
+    "CREATE TABLE IF NOT EXISTS dm_settings ("
+    "user_id INTEGER PRIMARY KEY, ai_model TEXT NOT NULL)"
+)
+dm_settings_writer = WriteBehind(
+    "INSERT OR REPLACE INTO dm_settings (user_id, ai_model) VALUES (?, ?)",
+    "DELETE FROM dm_settings WHERE user_id = ?"
+)
+write_behind_queues.append(dm_settings_writer)
+
+dm_models = {
+    user_id: model_key
+    for user_id, model_key in db.execute("SELECT user_id, ai_model FROM dm_settings")
+    if model_key in GEMINI_MODELS
+}
+
+def guild_model_key(guild_id: int, user_id: int) -> str:
+    """Model key selected for a guild, or for the user themself in DMs (guild 0)."""
+    if guild_id == 0:
+        return dm_models.get(user_id, DEFAULT_GEMINI_MODEL)
+    return guild_models.get(guild_id, DEFAULT_GEMINI_MODEL)
+
+def set_guild_model(guild_id: int, user_id: int, model_key: str):
+    if guild_id == 0:
+        dm_models[user_id] = model_key
+        dm_settings_writer.put(user_id, (user_id, model_key))
+        return
+    guild_models[guild_id] = model_key
+    guild_settings_writer.put(guild_id, (guild_id, model_key))
+
 # ================= AI MEMORY (PER USER) =================
-user_chats = {}
+AI_MAX_SESSIONS = int(os.getenv("AI_MAX_SESSIONS", "1000"))
+AI_SESSION_TTL = float(os.getenv("AI_SESSION_TTL", "1800"))  # Idle seconds before a session expires
+AI_SESSION_SWEEP_INTERVAL = float(os.getenv("AI_SESSION_SWEEP_INTERVAL", "60"))
+
+class SessionStore:
+    """Bounded LRU store for chat sessions with idle expiry.
+
+    Holds at most `max_entries` sessions, evicting the least recently used
+    one when full. Sessions idle for longer than `idle_ttl` seconds are
+    dropped on access or by `sweep()`.
+    """
+
+    def __init__(self, max_entries: int, idle_ttl: float):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()  # key -> (session, last_used)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is None or now - entry[1] > self.idle_ttl:
+            if entry is not None:
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+        self._entries[key] = (entry[0], now)
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, key):
+        """Return a live session without touching recency or hit/miss stats."""
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.idle_ttl:
+            return None
+        return entry[0]
+
+    def put(self, key, session):
+        self._entries[key] = (session, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        self._entries.clear()
+
+    def remove_where(self, predicate) -> int:
+        """Remove every session whose key matches `predicate`."""
+        keys = [key for key in self._entries if predicate(key)]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def sweep(self) -> int:
+        """Evict idle sessions. Returns how many were removed."""
+        # Entries are kept in last-used order, so stop at the first fresh one
+        cutoff = time.monotonic() - self.idle_ttl
+        removed = 0
+        while self._entries:
+            key, (_, last_used) = next(iter(self._entries.items()))
+            if last_used > cutoff:
+                break
+            del self._entries[key]
+            removed += 1
+        self.evictions += removed
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+user_chats = SessionStore(AI_MAX_SESSIONS, AI_SESSION_TTL)
+
+# Persisted history, hydrated lazily on a user's first message after restart
+db.execute(
+    "CREATE TABLE IF NOT EXISTS ai_sessions ("
+    "session_key TEXT PRIMARY KEY, history TEXT NOT NULL, updated_at REAL NOT NULL)"
+)
+session_writer = WriteBehind(
+    "INSERT OR REPLACE INTO ai_sessions (session_key, history, updated_at) VALUES (?, ?, ?)",
+    "DELETE FROM ai_sessions WHERE session_key = ?"
+)
+write_behind_queues.append(session_writer)
+
+def dump_history(chat) -> str:
+    return json.dumps(
+        [{"role": turn.role, "text": content_text(turn)} for turn in chat.history],
+        ensure_ascii=False
+    )
+
+def parse_history(data: str) -> list:
+    return [{"role": turn["role"], "parts": [turn["text"]]} for turn in json.loads(data)]
+
+def _select_session(key: str):
+    row = db.execute("SELECT history FROM ai_sessions WHERE session_key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+async def load_history(key: str) -> list:
+    """Stored history for a session, checking unflushed writes first."""
+    if key in session_writer.pending:
+        row = session_writer.pending[key]
+        return parse_history(row[1]) if row else []
+    data = await run_db(_select_session, key)
+    return parse_history(data) if data else []
+
+def session_key(guild_id: int, user_id: int, model_key: str = None) -> tuple:
+    """Sessions are scoped per (guild, user, model); guild 0 is DMs."""
+    return (guild_id, user_id, model_key or guild_model_key(guild_id, user_id))
+
+def storage_key(key: tuple) -> str:
+    return ":".join(map(str, key))
+
+def save_session(key: tuple, chat):
+    """Queue the session history for the next batched commit."""
+    stored = storage_key(key)
+    session_writer.put(stored, (stored, dump_history(chat), time.time()))
+
+def delete_user_sessions(guild_id: int, user_id: int):
+    """Forget a user's sessions in a guild, for every model."""
+    for model_key in GEMINI_MODELS:
+        key = session_key(guild_id, user_id, model_key)
+        user_chats.pop(key)
+        session_writer.delete(storage_key(key))
+
+def _delete_guild_sessions(guild_id: int):
+    with db:
+        db.execute("DELETE FROM ai_sessions WHERE session_key LIKE ?", (f"{guild_id}:%",))
+
+async def delete_guild_sessions(guild_id: int):
+    """Forget every session in a guild without touching other guilds."""
+    user_chats.remove_where(lambda key: key[0] == guild_id)
+    prefix = f"{guild_id}:"
+    for stored in [k for k in session_writer.pending if k.startswith(prefix)]:
+        del session_writer.pending[stored]
+    await run_db(_delete_guild_sessions, guild_id)
+
+async def get_user_chat(key: tuple):
+    chat = user_chats.get(key)
+    if chat is None:
+        history = await load_history(storage_key(key))
+        # Another message may have hydrated the session while we waited on disk;
+        # peek so this cold load isn't counted as a second miss
+        chat = user_chats.peek(key)
+        if chat is None:
+            chat = model_registry.get(key[2]).start_chat(history=history)
+            user_chats.put(key, chat)
+    return chat
+
+@tasks.loop(seconds=AI_SESSION_SWEEP_INTERVAL)
+async def sweep_ai_sessions():
+    user_chats.sweep()
+    ai_limiter.prune()
+    ai_pool.prune()
+    await response_cache.purge_expired()
+
+# ================= AI HISTORY COMPACTION =================
+AI_HISTORY_TURNS = int(os.getenv("AI_HISTORY_TURNS", "10"))  # Turns kept verbatim after a fold (folds at 2x)
+AI_HISTORY_TOKEN_BUDGET = int(os.getenv("AI_HISTORY_TOKEN_BUDGET", "8000"))
+AI_SUMMARIZE_HISTORY = os.getenv("AI_SUMMARIZE_HISTORY", "1") == "1"
+SUMMARY_PREFIX = "[Ringkasan percakapan sebelumnya]\n"
+
+def content_text(content) -> str:
+    """Plain text of a history entry."""
+    return "".join(part.text for part in content.parts)
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 chars per token) that needs no API call."""
+    return len(text) // 4 + 1
+
+def split_summary(history: list):
+    """Split history into (running summary, verbatim turns)."""
+    if history and history[0].role == "user":
+        first = content_text(history[0])
+        if first.startswith(SUMMARY_PREFIX):
+            return first[len(SUMMARY_PREFIX):], list(history[2:])
+    return "", list(history)
+
+def summary_turn(summary: str) -> list:
+    """History entries that carry the running summary."""
+    return [
+        {"role": "user", "parts": [SUMMARY_PREFIX + summary]},
+        {"role": "model", "parts": ["Baik, aku ingat konteks percakapan tersebut."]},
+    ]
+
+async def summarize_turns(gemini_model, summary: str, turns: list) -> str:
+    """Fold `turns` into the running summary."""
+    transcript = "\n".join(
+        f"{'User' if turn.role == 'user' else 'AI'}: {content_text(turn)}"
+        for turn in turns
+    )
+    response = await gemini_model.generate_content_async(
+        "Perbarui ringkasan percakapan berikut dengan singkat (maksimal 150 kata). "
+        "Pertahankan fakta penting tentang user dan topik yang dibahas.\n\n"
+        f"Ringkasan sebelumnya:\n{summary or '-'}\n\n"
+        f"Percakapan baru:\n{transcript}"
+    )
+    return response.text.strip()
+
+async def compact_chat(chat, prompt: str):
+    """Bound a session's history before sending `prompt`.
+
+    Once more than 2 x AI_HISTORY_TURNS turns pile up, folds everything but
+    the last AI_HISTORY_TURNS into a running summary. The gap between the two
+    marks means one summarize call per AI_HISTORY_TURNS turns rather than one
+    per turn. Then drops turns until the estimated prompt size fits
+    AI_HISTORY_TOKEN_BUDGET.
+    """
+    summary, turns = split_summary(chat.history)
+    changed = False
+
+    # A turn is a user/model pair, i.e. two history entries
+    if len(turns) > AI_HISTORY_TURNS * 4:
+        cut = len(turns) - AI_HISTORY_TURNS * 2
+        old, turns = turns[:cut], turns[cut:]
+        if AI_SUMMARIZE_HISTORY:
+            try:
+                summary = await summarize_turns(chat.model, summary, old)
+            except Exception:
+                pass  # Keep the previous summary, old turns are dropped anyway
+        changed = True
+
+    def prompt_size():
+        return (
+            estimate_tokens(summary)
+            + sum(estimate_tokens(content_text(turn)) for turn in turns)
+            + estimate_tokens(prompt)
+        )
+
+    while turns and prompt_size() > AI_HISTORY_TOKEN_BUDGET:
+        turns = turns[2:]  # Drop the oldest user/model pair
+        changed = True
+
+    if summary and prompt_size() > AI_HISTORY_TOKEN_BUDGET:
+        summary = summary[:max(0, AI_HISTORY_TOKEN_BUDGET - estimate_tokens(prompt)) * 4]
+        changed = True
+
+    if changed:
+        chat.history = (summary_turn(summary) if summary else []) + turns
+
+# ================= AI SCHEDULER =================
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", "20"))
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "60"))
+AI_USER_BURST = float(os.getenv("AI_USER_BURST", "3"))
+AI_USER_REFILL = float(os.getenv("AI_USER_REFILL", "0.1"))  # Requests per second
+AI_GUILD_BURST = float(os.getenv("AI_GUILD_BURST", "20"))
+AI_GUILD_REFILL = float(os.getenv("AI_GUILD_REFILL", "1.0"))
+AI_GUILD_WEIGHTS = parse_weights(os.getenv("AI_GUILD_WEIGHTS", ""))  # "guild_id:weight,..."
+
+ai_pool = FairScheduler(AI_MAX_CONCURRENCY, AI_MAX_QUEUE, AI_TIMEOUT, AI_GUILD_WEIGHTS)
+ai_limiter = RateLimiter(AI_USER_REFILL, AI_USER_BURST, AI_GUILD_REFILL, AI_GUILD_BURST)
+
+# ================= AI STREAMING =================
+AI_STREAMING = os.getenv("AI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+DISCORD_MESSAGE_LIMIT = 2000
+
+class StreamingReply:
+    """Render streamed AI text progressively into Discord messages.
+
+    The first chunk is posted as soon as it arrives, after that the current
+    message is edited at most once per `interval` seconds. Text past the
+    2000-char limit continues in a new message.
+    """
+
+    def __init__(self, send, interval: float = STREAM_EDIT_INTERVAL):
+        self.send = send  # async callable(content) -> discord.Message
+        self.interval = interval
+        self.message = None
+        self.text = ""
+        self.full_text = ""
+        self.rendered = ""
+        self.last_edit = 0.0
+
+    async def feed(self, chunk: str):
+        self.text += chunk
+        self.full_text += chunk
+        while len(self.text) > DISCORD_MESSAGE_LIMIT:
+            cut = self.text.rfind("\n", DISCORD_MESSAGE_LIMIT // 2, DISCORD_MESSAGE_LIMIT)
+            if cut == -1:
+                cut = DISCORD_MESSAGE_LIMIT
+            head, self.text = self.text[:cut], self.text[cut:].lstrip("\n")
+            await self._render(head, force=True)
+            self.message = None
+            self.rendered = ""
+
+        if self.text:
+            await self._render(self.text)
+
+    async def finish(self):
+        """Flush whatever is still pending."""
+        if self.message is None or self.text != self.rendered:
+            await self._render(self.text or "...", force=True)
+
+    async def _render(self, content: str, force: bool = False):
+        if self.message is None:
+            self.message = await self.send(content)
+        elif content != self.rendered:
+            wait = self.interval - (time.monotonic() - self.last_edit)
+            if wait > 0:
+                if not force:
+                    return
+                await asyncio.sleep(wait)
+            await self.message.edit(content=content)
+        else:
+            return
+        self.rendered = content
+        self.last_edit = time.monotonic()
+
+def chunk_text(chunk) -> str:
+    """Text of a streamed chunk, empty if it carries no text parts."""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+async def send_ai_response(chat, prompt: str, reply: StreamingReply):
+    """Send `prompt` to the chat session and render the answer into `reply`."""
+    await compact_chat(chat, prompt)
+    if AI_STREAMING:
+        response = await chat.send_message_async(prompt, stream=True)
+        async for chunk in response:
+            await reply.feed(chunk_text(chunk))
+    else:
+        response = await chat.send_message_async(prompt)
+        await reply.feed(response.text)
+    await reply.finish()
+
+def discard_last_turn(chat):
+    """Drop a half-finished turn so the session history stays usable."""
+    if chat.last is not None:
+        chat.rewind()
+
+# ================= AI RESPONSE CACHE =================
+AI_CACHE_ENABLED = os.getenv("AI_CACHE_ENABLED", "0") == "1"
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "500"))
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", "3600"))
+AI_CACHE_DISK = os.getenv("AI_CACHE_DISK", "0") == "1"
+CACHE_HIT_MARKER = "\n-# ⚡ cached"
+
+class TTLCache:
+    """Small LRU cache whose entries expire `ttl` seconds after insertion."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.time():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, expires_at: float = None):
+        self._entries[key] = (value, expires_at or time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        self._entries.clear()
+
+db.execute(
+    "CREATE TABLE IF NOT EXISTS ai_cache ("
+    "cache_key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+)
+cache_writer = WriteBehind(
+    "INSERT OR REPLACE INTO ai_cache (cache_key, response, expires_at) VALUES (?, ?, ?)",
+    "DELETE FROM ai_cache WHERE cache_key = ?"
+)
+write_behind_queues.append(cache_writer)
+
+class ResponseCache:
+    """Cache for context-free AI answers: in-memory LRU plus optional SQLite tier."""
+
+    def __init__(self, max_entries: int, ttl: float, use_disk: bool):
+        self.memory = TTLCache(max_entries, ttl)
+        self.ttl = ttl
+        self.use_disk = use_disk
+
+    @staticmethod
+    def make_key(model_name: str, prompt: str) -> str:
+        normalized = re.sub(r"\s+", " ", prompt.lower()).strip().rstrip("?!. ")
+        raw = json.dumps([model_name, SYSTEM_INSTRUCTION, normalized])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def _select(key: str):
+        return db.execute(
+            "SELECT response, expires_at FROM ai_cache WHERE cache_key = ? AND expires_at > ?",
+            (key, time.time())
+        ).fetchone()
+
+    async def get(self, key: str):
+        text = self.memory.get(key)
+        if text is not None or not self.use_disk:
+            return text
+        row = await run_db(self._select, key)
+        if row is None:
+            return None
+        self.memory.put(key, row[0], expires_at=row[1])
+        return row[0]
+
+    def put(self, key: str, text: str):
+        expires_at = time.time() + self.ttl
+        self.memory.put(key, text, expires_at=expires_at)
+        if self.use_disk:
+            cache_writer.put(key, (key, text, expires_at))
+
+    @staticmethod
+    def _purge_expired():
+        with db:
+            db.execute("DELETE FROM ai_cache WHERE expires_at <= ?", (time.time(),))
+
+    async def purge_expired(self):
+        if self.use_disk:
+            await run_db(self._purge_expired)
+
+response_cache = ResponseCache(AI_CACHE_SIZE, AI_CACHE_TTL, AI_CACHE_DISK)
+
+def remember_turn(chat, prompt: str, text: str):
+    """Append a turn answered outside the chat session to its history."""
+    chat.history = [
+        *chat.history,
+        {"role": "user", "parts": [prompt]},
+        {"role": "model", "parts": [text]},
+    ]
+
+# ================= AI REQUEST COALESCING =================
+AI_COALESCE_ENABLED = os.getenv("AI_COALESCE_ENABLED", "1") == "1"
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers with the same key."""
+
+    def __init__(self):
+        self._inflight = {}  # key -> asyncio.Future
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def get(self, key):
+        """Future of the in-flight call for `key`, if any."""
+        return self._inflight.get(key)
+
+    async def run(self, key, func, *args):
+        """Run `func(*args)` as the leader for `key` and publish its result."""
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await func(*args)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Waiters re-raise it, don't warn when there are none
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+ai_inflight = SingleFlight()
+
+async def answer_in_pool(guild_id: int, chat, prompt: str, reply: StreamingReply) -> str:
+    if ai_pool.is_full():
+        raise AIBusyError()
+    position = ai_pool.queue_position()
+    if position:
+        await reply.send(f"⏳ AI sedang sibuk, kamu di antrian ke-**{position}**...")
+
+    await ai_pool.run(guild_id, send_ai_response, chat, prompt, reply)
+    return reply.full_text
+
+async def generate_ai_reply(guild_id: int, chat, prompt: str, reply: StreamingReply):
+    """Answer `prompt` into `reply`.
+
+    Context-free prompts are served from the response cache or joined onto
+    an identical in-flight request when possible. Raises AIBusyError when
+    the worker pool cannot take the request.
+    """
+    if chat.history or not (AI_CACHE_ENABLED or AI_COALESCE_ENABLED):
+        await answer_in_pool(guild_id, chat, prompt, reply)
+        return
+
+    key = ResponseCache.make_key(chat.model.model_name, prompt)
+    shared = None
+    if AI_CACHE_ENABLED:
+        shared = await response_cache.get(key)
+        marker = CACHE_HIT_MARKER
+    if shared is None and AI_COALESCE_ENABLED and ai_inflight.get(key) is not None:
+        shared = await asyncio.shield(ai_inflight.get(key))
+        marker = ""
+
+    if shared is not None:
+        remember_turn(chat, prompt, shared)
+        await reply.feed(shared + marker)
+        await reply.finish()
+        return
+
+    if AI_COALESCE_ENABLED:
+        text = await ai_inflight.run(key, answer_in_pool, guild_id, chat, prompt, reply)
+    else:
+        text = await answer_in_pool(guild_id, chat, prompt, reply)
+    if AI_CACHE_ENABLED:
+        response_cache.put(key, text)
+
+# ================= AI MAILBOX (PER USER) =================
+AI_MAILBOX_DEPTH = int(os.getenv("AI_MAILBOX_DEPTH", "3"))
+AI_MAILBOX_SUPERSEDE = os.getenv("AI_MAILBOX_SUPERSEDE", "0") == "1"
 
-def get_user_chat(user_id: int):
-    if user_id not in user_chats:
-        user_chats[user_id] = model.start_chat()
-    return user_chats[user_id]
+class MailboxFullError(Exception):
+    """Raised when a user already has too many queued AI messages."""
+
+class SupersededError(Exception):
+    """Raised for a queued AI message replaced by a newer one."""
+
+class UserMailbox:
+    """Ordered per-key dispatch queue.
+
+    Jobs for one key run strictly one after another, jobs for different
+    keys run in parallel. At most `max_depth` jobs wait per key; with
+    `supersede` a new job replaces the ones still waiting instead.
+    """
+
+    def __init__(self, max_depth: int, supersede: bool):
+        self.max_depth = max_depth
+        self.supersede = supersede
+        self._queues = {}   # key -> deque of (future, func, args)
+        self._workers = {}  # key -> asyncio.Task draining that queue
+
+    def depth(self, key) -> int:
+        return len(self._queues.get(key, ()))
+
+    async def submit(self, key, func, *args):
+        """Queue `func(*args)` behind the key's earlier jobs and await its result."""
+        queue = self._queues.setdefault(key, deque())
+        if self.supersede:
+            while queue:
+                future, _, _ = queue.popleft()
+                if not future.done():
+                    future.set_exception(SupersededError())
+        elif len(queue) >= self.max_depth:
+            raise MailboxFullError()
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append((future, func, args))
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._drain(key))
+        return await future
+
+    async def _drain(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                future, func, args = queue.popleft()
+                if future.done():
+                    continue  # Caller gave up while it was queued
+                try:
+                    result = await func(*args)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            del self._workers[key]
+            if not queue:
+                del self._queues[key]
+
+ai_mailbox = UserMailbox(AI_MAILBOX_DEPTH, AI_MAILBOX_SUPERSEDE)
+
+async def run_ai_turn(user_id: int, guild_id: int, prompt: str, reply: StreamingReply):
+    """One full AI turn for a user; runs inside that user's mailbox."""
+    key = session_key(guild_id, user_id)
+    chat = await get_user_chat(key)
+    try:
+        await generate_ai_reply(guild_id, chat, prompt, reply)
+    except Exception:
+        discard_last_turn(chat)
+        raise
+    save_session(key, chat)
+
+# ================= AI DISPATCH =================
+def ai_error_message(error: Exception) -> str:
+    """User-facing reply for an error raised while handling an AI prompt."""
+    if isinstance(error, RateLimited):
+        return f"🐢 Terlalu cepat! Coba lagi dalam **{error.retry_after:.1f} detik**."
+    if isinstance(error, AIBusyError):
+        return "⏳ AI sedang sibuk, coba lagi sebentar lagi."
+    if isinstance(error, MailboxFullError):
+        return "⏳ Tunggu jawaban sebelumnya selesai dulu."
+    if isinstance(error, SupersededError):
+        return "⏭️ Pesan ini dilewati karena kamu mengirim pesan baru."
+    if isinstance(error, asyncio.TimeoutError):
+        return "⏰ AI terlalu lama merespon, coba lagi."
+    print(f"AI error: {error}")
+    return "❌ Terjadi error saat memproses AI."
+
+async def dispatch_ai(target, prompt: str):
+    """Shared entry point for the prefix `ai` and slash `/ai` commands.
+
+    `target` is a commands.Context or a discord.Interaction. Session lookup,
+    rate limits, the per-user mailbox, streamed output and error replies
+    all go through here.
+    """
+    if isinstance(target, discord.Interaction):
+        # Acknowledge right away, interactions expire after 3 seconds
+        if not target.response.is_done():
+            await target.response.defer(thinking=True)
+        user = target.user
+        guild_id = target.guild_id or 0
+        send = lambda content: target.followup.send(content, wait=True)
+    else:
+        user = target.author
+        guild_id = target.guild.id if target.guild else 0
+        send = target.send
+
+    reply = StreamingReply(send)
+    try:
+        ai_limiter.check(user.id, guild_id)
+        if not isinstance(target, discord.Interaction):
+            await target.typing()
+        await ai_mailbox.submit((guild_id, user.id), run_ai_turn, user.id, guild_id, prompt, reply)
+    except Exception as e:
+        await send(ai_error_message(e))
 # ================= DISCORD BOT =================
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = commands.AutoShardedBot(
+# Startup profile for the member cache:
+#   full    - chunk every guild at startup and keep every member (most RAM, slowest ready)
+#   lean    - same cache flags as full, but no startup chunking: only members who
+#             join or enter voice while the bot runs end up cached
+#   minimal - no startup chunking and no member cache beyond the bot itself
+# Commands that need members fall back to on-demand lookups (see MEMBER LOOKUP).
+MEMBER_CACHE_PROFILES = {
+    "full": (discord.MemberCacheFlags.all, True),
+    "lean": (discord.MemberCacheFlags.all, False),
+    "minimal": (discord.MemberCacheFlags.none, False),
+}
+MEMBER_CACHE_PROFILE = os.getenv("MEMBER_CACHE_PROFILE", "full").lower()
+if MEMBER_CACHE_PROFILE not in MEMBER_CACHE_PROFILES:
+    MEMBER_CACHE_PROFILE = "full"
+member_cache_flags, chunk_at_startup = MEMBER_CACHE_PROFILES[MEMBER_CACHE_PROFILE]
+
+class DiscordBot(commands.AutoShardedBot):
+    async def close(self):
+        # Commit buffered writes before the connection goes away
+        job_scheduler.stop()
+        flush_write_behind.cancel()
+        await flush_all_write_behind()
+        await super().close()
+
+bot = DiscordBot(
     command_prefix="/",
     intents=intents,
+    member_cache_flags=member_cache_flags(),
+    chunk_guilds_at_startup=chunk_at_startup,
     help_command=None  # Disable default help command
 )
 
 # Track bot start time for uptime
 start_time = datetime.datetime.now()
 
-# AFK users storage
-afk_users = {}
+# ================= MEMBER LOOKUP =================
+# With a lean member cache, members are resolved on demand and kept briefly
+MEMBER_LOOKUP_CACHE_SIZE = int(os.getenv("MEMBER_LOOKUP_CACHE_SIZE", "5000"))
+MEMBER_LOOKUP_TTL = float(os.getenv("MEMBER_LOOKUP_TTL", "300"))
+QUERY_MEMBERS_BATCH = 100  # Discord's limit on user_ids per member request
+
+member_lookups = TTLCache(MEMBER_LOOKUP_CACHE_SIZE, MEMBER_LOOKUP_TTL)  # (guild_id, user_id) -> Member
+
+async def resolve_member(guild: discord.Guild, user_id: int):
+    """Member from the gateway cache, the lookup cache or a single fetch_member; None if gone."""
+    member = guild.get_member(user_id) or member_lookups.get((guild.id, user_id))
+    if member is None:
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            return None
+        member_lookups.put((guild.id, user_id), member)
+    return member
+
+async def resolve_members(guild: discord.Guild, user_ids: list) -> dict:
+    """Resolve many members at once; cache misses go out as bulk query_members requests."""
+    found = {}
+    missing = []
+    for user_id in user_ids:
+        member = guild.get_member(user_id) or member_lookups.get((guild.id, user_id))
+        if member is not None:
+            found[user_id] = member
+        else:
+            missing.append(user_id)
+
+    for i in range(0, len(missing), QUERY_MEMBERS_BATCH):
+        try:
+            members = await guild.query_members(user_ids=missing[i:i + QUERY_MEMBERS_BATCH], cache=False)
+        except asyncio.TimeoutError:
+            continue
+        for member in members:
+            found[member.id] = member
+            member_lookups.put((guild.id, member.id), member)
+    return found
+
+class CachedMember(commands.MemberConverter):
+    """Member converter that resolves mentions and ids through `resolve_member` first."""
+
+    async def convert(self, ctx, argument: str):
+        match = re.fullmatch(r"<@!?(\d+)>|(\d{15,20})", argument)
+        if match and ctx.guild is not None:
+            member = await resolve_member(ctx.guild, int(match.group(1) or match.group(2)))
+            if member is not None:
+                return member
+        return await super().convert(ctx, argument)
+
+# ================= AFK REGISTRY =================
+AFK_TTL = float(os.getenv("AFK_TTL", "86400"))                   # AFK status expires after this many seconds
+AFK_NOTICE_WINDOW = float(os.getenv("AFK_NOTICE_WINDOW", "60"))  # Repeat notices per channel are muted this long
+
+db.execute(
+    "CREATE TABLE IF NOT EXISTS afk_users ("
+    "user_id INTEGER PRIMARY KEY, reason TEXT NOT NULL, since REAL NOT NULL)"
+)
+afk_writer = WriteBehind(
+    "INSERT OR REPLACE INTO afk_users (user_id, reason, since) VALUES (?, ?, ?)",
+    "DELETE FROM afk_users WHERE user_id = ?"
+)
+write_behind_queues.append(afk_writer)
+
+class AFKRegistry:
+    """AFK statuses keyed by user id, expiring after `ttl`.
+
+    Also remembers when each AFK user was last announced in a channel so a
+    busy channel pinging them over and over only gets one notice per window.
+    """
+
+    def __init__(self, ttl: float, notice_window: float):
+        self.ttl = ttl
+        self.notice_window = notice_window
+        self.users = {}     # user_id -> (reason, since epoch seconds)
+        self._notices = {}  # (channel_id, user_id) -> monotonic time of last notice
+
+    def load(self):
+        cutoff = time.time() - self.ttl
+        for user_id, reason, since in db.execute("SELECT user_id, reason, since FROM afk_users"):
+            if since >= cutoff:
+                self.users[user_id] = (reason, since)
+            else:
+                afk_writer.delete(user_id)
+
+    def set(self, user_id: int, reason: str):
+        since = time.time()
+        self.users[user_id] = (reason, since)
+        afk_writer.put(user_id, (user_id, reason, since))
+
+    def get(self, user_id: int):
+        status = self.users.get(user_id)
+        if status is not None and time.time() - status[1] > self.ttl:
+            self.pop(user_id)
+            return None
+        return status
+
+    def pop(self, user_id: int):
+        status = self.users.pop(user_id, None)
+        if status is not None:
+            afk_writer.delete(user_id)
+            for key in [k for k in self._notices if k[1] == user_id]:
+                del self._notices[key]
+        return status
+
+    def should_notify(self, channel_id: int, user_id: int) -> bool:
+        now = time.monotonic()
+        key = (channel_id, user_id)
+        if now - self._notices.get(key, -self.notice_window) < self.notice_window:
+            return False
+        self._notices[key] = now
+        return True
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        for user_id in [u for u, (_, since) in self.users.items() if since < cutoff]:
+            self.pop(user_id)
+        now = time.monotonic()
+        for key in [k for k, t in self._notices.items() if now - t >= self.notice_window]:
+            del self._notices[key]
+
+afk_registry = AFKRegistry(AFK_TTL, AFK_NOTICE_WINDOW)
+afk_registry.load()
+
+@tasks.loop(minutes=10)
+async def sweep_afk():
+    afk_registry.sweep()
+
+# ================= JOB SCHEDULER =================
+# timer, remind and giveaway all share one persistent min-heap instead of
+# keeping a sleeping task (and its ctx) alive per pending job.
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "50"))
+
+db.execute(
+    "CREATE TABLE IF NOT EXISTS scheduled_jobs ("
+    "job_id INTEGER PRIMARY KEY, kind TEXT NOT NULL, due_at REAL NOT NULL, "
+    "guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+    "payload TEXT NOT NULL)"
+)
+job_writer = WriteBehind(
+    "INSERT OR REPLACE INTO scheduled_jobs "
+    "(job_id, kind, due_at, guild_id, channel_id, user_id, payload) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    "DELETE FROM scheduled_jobs WHERE job_id = ?"
+)
+write_behind_queues.append(job_writer)
+
+class ScheduledJob:
+    """One pending job: what to run, when, and where to report it."""
+
+    __slots__ = ("job_id", "kind", "due_at", "guild_id", "channel_id", "user_id", "payload")
+
+    def __init__(self, job_id, kind, due_at, guild_id, channel_id, user_id, payload):
+        self.job_id = job_id
+        self.kind = kind
+        self.due_at = due_at
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.payload = payload
+
+    def row(self) -> tuple:
+        return (self.job_id, self.kind, self.due_at, self.guild_id, self.channel_id,
+                self.user_id, json.dumps(self.payload))
+
+class JobScheduler:
+    """Min-heap of due times served by a single dispatcher task.
+
+    The dispatcher only pops due jobs and starts each handler as its own
+    task, so a handler waiting on the network never holds up later jobs.
+
+    Jobs are persisted through a write-behind queue and reloaded on startup,
+    so anything that came due while the bot was offline fires right away.
+    Cancelled jobs are dropped from `jobs` and skipped lazily in the heap.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.jobs = {}   # job_id -> ScheduledJob
+        self._heap = []  # (due_at, job_id)
+        self._handlers = {}
+        self._next_id = 1
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()  # Handler tasks still in progress
+
+    def handler(self, kind: str):
+        """Register the coroutine that runs jobs of this kind."""
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    def load(self):
+        for job_id, kind, due_at, guild_id, channel_id, user_id, payload in db.execute(
+            "SELECT job_id, kind, due_at, guild_id, channel_id, user_id, payload FROM scheduled_jobs"
+        ):
+            self._push(ScheduledJob(job_id, kind, due_at, guild_id, channel_id, user_id, json.loads(payload)))
+            self._next_id = max(self._next_id, job_id + 1)
+
+    def _push(self, job: ScheduledJob):
+        self.jobs[job.job_id] = job
+        heapq.heappush(self._heap, (job.due_at, job.job_id))
+
+    def schedule(self, kind: str, delay: float, guild_id: int, channel_id: int, user_id: int, **payload) -> ScheduledJob:
+        job = ScheduledJob(self._next_id, kind, time.time() + delay, guild_id, channel_id, user_id, payload)
+        self._next_id += 1
+        self._push(job)
+        job_writer.put(job.job_id, job.row())
+        if self._heap[0][1] == job.job_id:
+            self._wakeup.set()  # New earliest job, re-arm the dispatcher
+        return job
+
+    def cancel(self, job_id: int) -> bool:
+        if self.jobs.pop(job_id, None) is None:
+            return False
+        job_writer.delete(job_id)
+        return True
+
+    def pending(self, user_id: int, kinds: tuple) -> list:
+        """A user's pending jobs of the given kinds, soonest first."""
+        return sorted(
+            (job for job in self.jobs.values() if job.user_id == user_id and job.kind in kinds),
+            key=lambda job: job.due_at
+        )
+
+    def _pop_due(self, now: float) -> list:
+        batch = []
+        while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+            _, job_id = heapq.heappop(self._heap)
+            job = self.jobs.pop(job_id, None)
+            if job is not None:
+                job_writer.delete(job_id)
+                batch.append(job)
+        return batch
+
+    async def _fire(self, job: ScheduledJob):
+        handler = self._handlers.get(job.kind)
+        if handler is None:
+            print(f"Scheduler: no handler for job kind {job.kind!r}")
+            return
+        try:
+            await handler(job)
+        except Exception as e:
+            print(f"Scheduler job {job.job_id} ({job.kind}) error: {e}")
+
+    async def _run(self):
+        while True:
+            batch = self._pop_due(time.time())
+            if batch:
+                # Handlers run on their own so a slow one never delays later jobs
+                for job in batch:
+                    task = asyncio.create_task(self._fire(job))
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+                await asyncio.sleep(0)  # Let the batch start before popping the next one
+                continue
+
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._running:
+            task.cancel()
+
+job_scheduler = JobScheduler(SCHEDULER_BATCH_SIZE)
+job_scheduler.load()
+
+async def resolve_channel(channel_id: int):
+    """Cached channel, falling back to the API for channels not in cache."""
+    channel = bot.get_channel(channel_id)
+    if channel is None:
+        try:
+            channel = await bot.fetch_channel(channel_id)
+        except discord.HTTPException:
+            return None
+    return channel
 
 # ================= INTERACTIVE MENUS =================
 
@@ -151,7 +1265,8 @@ class HelpSelect(ui.Select):
                 description=(
                     "`/kick @user [alasan]` - Kick member\n"
                     "`/warn @user [alasan]` - Warn member\n"
-                    "`/clear <jumlah>` - Hapus pesan (1-100)\n\n"
+                    "`/clear <jumlah>` - Hapus pesan (1-100)\n"
+                    "`/automod [aksi]` - Auto-mod flood & spam\n\n"
                     "⚠️ Membutuhkan permission yang sesuai!"
                 ),
                 color=discord.Color.red()
@@ -162,7 +1277,12 @@ class HelpSelect(ui.Select):
                     "`/poll \"pertanyaan\" \"opsi1\" \"opsi2\"` - Buat poll\n"
                     "`/timer <waktu>` - Set timer (5s, 10m, 1h)\n"
                     "`/remind <waktu> <pesan>` - Set reminder\n"
-                    "`/giveaway <waktu> <hadiah>` - Buat giveaway\n"
+                    "`/reminders` - Lihat timer & reminder aktif\n"
+                    "`/cancelremind <id>` - Batalkan reminder\n"
+                    "`/giveaway <waktu> [n]w <hadiah>` - Buat giveaway\n"
+                    "`/addtrigger \"kata\" <balasan>` - Tambah auto-reply\n"
+                    "`/deltrigger <kata>` - Hapus auto-reply\n"
+                    "`/triggers` - Daftar auto-reply\n"
                     "`/math <expr>` - Kalkulator\n"
                     "`/say <pesan>` - Bot kirim pesan\n"
                     "`/embed \"judul\" deskripsi` - Buat embed"
@@ -195,7 +1315,8 @@ class HelpSelect(ui.Select):
                 title="⭐ Leveling System",
                 description=(
                     "`/rank [@user]` - Lihat level & XP\n"
-                    "`/leaderboard` - Top 10 XP\n\n"
+                    "`/leaderboard [halaman]` - Top 10 XP\n"
+                    "`/xpexport` - Export data XP (CSV)\n\n"
                     "📈 **Cara dapat XP:**\n"
                     "• Kirim pesan (+1-5 XP)\n"
                     "• Menang trivia (+25 XP)\n"
@@ -275,9 +1396,10 @@ class MainMenuView(ui.View):
         embed = discord.Embed(title=f"🏠 {guild.name}", color=discord.Color.gold())
         if guild.icon:
             embed.set_thumbnail(url=guild.icon.url)
+        stats = guild_stats(guild)
         embed.add_field(name="Members", value=guild.member_count, inline=True)
-        embed.add_field(name="Channels", value=len(guild.channels), inline=True)
-        embed.add_field(name="Roles", value=len(guild.roles), inline=True)
+        embed.add_field(name="Channels", value=stats.channels, inline=True)
+        embed.add_field(name="Roles", value=stats.roles, inline=True)
         await interaction.response.send_message(embed=embed, ephemeral=True)
     
     @ui.button(label="📚 Help", style=discord.ButtonStyle.primary, row=1)
@@ -342,27 +1464,23 @@ class RoleView(ui.View):
 
 # AI Model Select Menu
 class AIModelSelect(ui.Select):
-    def __init__(self):
+    def __init__(self, guild_id: int, user_id: int):
         options = [
             discord.SelectOption(
                 label=f"{info['emoji']} {key.upper()}",
                 value=key,
                 description=f"{info['name']} - {info['description']}",
-                default=(key == current_gemini_model)
+                default=(key == guild_model_key(guild_id, user_id))
             )
             for key, info in GEMINI_MODELS.items()
         ]
         super().__init__(placeholder="🤖 Pilih model AI...", options=options)
     
     async def callback(self, interaction: discord.Interaction):
-        global current_gemini_model, model, user_chats
-        
+        guild_id = interaction.guild_id or 0
         selected = self.values[0]
-        current_gemini_model = selected
-        model = create_model(selected)
-        
-        # Clear all user chats when model changes
-        user_chats.clear()
+        # Only this guild (or this DM user) switches; sessions are keyed per model so nothing is flushed
+        set_guild_model(guild_id, interaction.user.id, selected)
         
         info = GEMINI_MODELS[selected]
         embed = discord.Embed(
@@ -371,17 +1489,18 @@ class AIModelSelect(ui.Select):
             color=discord.Color.green()
         )
         embed.add_field(name="Description", value=info['description'], inline=False)
-        embed.add_field(name="Note", value="⚠️ Memory AI telah direset untuk semua user.", inline=False)
-        await interaction.response.edit_message(embed=embed, view=AIModelView())
+        scope = "server ini" if guild_id else "DM kamu"
+        embed.add_field(name="Note", value=f"💾 Hanya berlaku untuk {scope}, riwayat model lain tetap tersimpan.", inline=False)
+        await interaction.response.edit_message(embed=embed, view=AIModelView(guild_id, interaction.user.id))
 
 class AIModelView(ui.View):
-    def __init__(self):
+    def __init__(self, guild_id: int, user_id: int):
         super().__init__(timeout=120)
-        self.add_item(AIModelSelect())
+        self.add_item(AIModelSelect(guild_id, user_id))
     
     @ui.button(label="📊 Model Info", style=discord.ButtonStyle.secondary, row=1)
     async def info_btn(self, interaction: discord.Interaction, button: ui.Button):
-        info = GEMINI_MODELS[current_gemini_model]
+        info = GEMINI_MODELS[guild_model_key(interaction.guild_id or 0, interaction.user.id)]
         embed = discord.Embed(
             title="📊 Current AI Model",
             color=discord.Color.blue()
@@ -389,33 +1508,235 @@ class AIModelView(ui.View):
         embed.add_field(name="Model", value=info['name'], inline=True)
         embed.add_field(name="Type", value=info['description'], inline=True)
         embed.add_field(name="Active Users", value=len(user_chats), inline=True)
+        stats = user_chats.stats()
+        embed.add_field(
+            name="Session Cache",
+            value=f"Hit: {stats['hits']} | Miss: {stats['misses']} | Evicted: {stats['evictions']}",
+            inline=False
+        )
         await interaction.response.send_message(embed=embed, ephemeral=True)
     
     @ui.button(label="🗑️ Reset All Memory", style=discord.ButtonStyle.danger, row=1)
     async def reset_btn(self, interaction: discord.Interaction, button: ui.Button):
-        user_chats.clear()
-        await interaction.response.send_message("✅ Memory AI untuk semua user telah direset!", ephemeral=True)
+        if interaction.guild_id is None:
+            # DMs share guild id 0, so only the caller's own sessions may go
+            delete_user_sessions(0, interaction.user.id)
+            await interaction.response.send_message("✅ Memory AI kamu telah direset!", ephemeral=True)
+            return
+        await delete_guild_sessions(interaction.guild_id)
+        await interaction.response.send_message("✅ Memory AI untuk semua user di server ini telah direset!", ephemeral=True)
 
 # ================= EVENTS =================
+DEV_GUILD_ID = int(os.getenv("DEV_GUILD_ID", "0"))  # Sync commands only to this guild (instant, for testing)
+
+db.execute("CREATE TABLE IF NOT EXISTS app_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+def command_tree_hash(guild) -> str:
+    """Stable hash of the app command payloads that a sync would upload."""
+    payload = sorted(
+        (cmd.to_dict(bot.tree) for cmd in bot.tree.get_commands(guild=guild)),
+        key=lambda data: (data.get("type", 1), data["name"])
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def load_state(key: str):
+    row = db.execute("SELECT value FROM app_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def save_state(key: str, value: str):
+    with db:
+        db.execute("INSERT OR REPLACE INTO app_state (key, value) VALUES (?, ?)", (key, value))
+
+async def sync_command_tree():
+    """Upload app commands only when they differ from the last successful sync."""
+    guild = None
+    if DEV_GUILD_ID:
+        guild = discord.Object(id=DEV_GUILD_ID)
+        bot.tree.copy_global_to(guild=guild)
+
+    state_key = f"tree_hash:{bot.application_id}:{DEV_GUILD_ID or 'global'}"
+    tree_hash = command_tree_hash(guild)
+    if await run_db(load_state, state_key) == tree_hash:
+        print("Slash commands tidak berubah, sync dilewati")
+        return
+
+    try:
+        synced = await bot.tree.sync(guild=guild)
+    except discord.HTTPException as e:
+        # Keep the stored hash so the next start tries again
+        print(f"Sync slash command gagal: {e}")
+        return
+    await run_db(save_state, state_key, tree_hash)
+    print(f"Sync {len(synced)} slash command ke {'guild ' + str(DEV_GUILD_ID) if guild else 'global'}")
+
+@bot.event
+async def setup_hook():
+    sweep_ai_sessions.start()
+    sweep_afk.start()
+    flush_write_behind.start()
+    job_scheduler.start()
+    bot.add_view(GiveawayView())  # Re-attach join buttons of giveaways that survived a restart
+    # setup_hook runs once per process, so reconnects never re-upload the tree
+    await sync_command_tree()
+
 @bot.event
 async def on_ready():
-    await bot.tree.sync()
     print(
         f"Bot login sebagai {bot.user}\n"
         f"Shard Count : {bot.shard_count}\n"
         f"Node        : {socket.gethostname()}"
     )
 
+class MessagePipeline:
+    """Single on_message path: a cheap pre-filter, then registered stages in order.
+
+    Stages run one after another so state changes (XP, counting) stay ordered,
+    and hand slow side effects such as sends and reactions to `defer`; those
+    are awaited together at the end. Every stage and its deferred work is
+    timed separately in `stats`. A stage returns True to stop the pipeline.
+    """
+
+    def __init__(self):
+        self._stages = []  # (order, name, func)
+        self.stats = {}    # name -> [calls, total seconds, max seconds]
+
+    def stage(self, name: str, order: int):
+        def decorator(func):
+            self._stages.append((order, name, func))
+            self._stages.sort(key=lambda stage: stage[0])
+            return func
+        return decorator
+
+    def accepts(self, message) -> bool:
+        return not message.author.bot
+
+    def _record(self, name: str, elapsed: float):
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = self.stats[name] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += elapsed
+        stat[2] = max(stat[2], elapsed)
+
+    async def _timed(self, name: str, coro):
+        start = time.perf_counter()
+        try:
+            await coro
+        except Exception as e:
+            print(f"Message stage {name} error: {e}")
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    async def run(self, message):
+        if not self.accepts(message):
+            return
+
+        effects = []
+        for _, name, func in self._stages:
+            def defer(coro, name=f"{name} (async)"):
+                effects.append(self._timed(name, coro))
+
+            start = time.perf_counter()
+            try:
+                stop = await func(message, defer)
+            except Exception as e:
+                print(f"Message stage {name} error: {e}")
+                stop = False
+            self._record(name, time.perf_counter() - start)
+            if stop:
+                break
+
+        if effects:
+            await asyncio.gather(*effects)
+
+message_pipeline = MessagePipeline()
+
 @bot.event
 async def on_message(message):
-    if message.author.bot:
-        return
+    await message_pipeline.run(message)
 
-    # Auto reply
-    if "halo bot" in message.content.lower():
-        await message.channel.send("Halo juga 👋")
+# ================= GUILD STATS CACHE =================
+class GuildStats:
+    """Member, channel and role tallies for one guild, kept current by gateway events.
 
-    await bot.process_commands(message)
+    `bots` is counted from cached members, so it is exact only with the
+    full member cache profile.
+    """
+
+    __slots__ = ("bots", "channels", "text_channels", "voice_channels", "roles")
+
+    def __init__(self, guild: discord.Guild):
+        self.bots = sum(1 for member in guild.members if member.bot)
+        self.channels = len(guild.channels)
+        self.text_channels = len(guild.text_channels)
+        self.voice_channels = len(guild.voice_channels)
+        self.roles = len(guild.roles)
+
+    def channel_delta(self, channel, delta: int):
+        self.channels += delta
+        if isinstance(channel, discord.TextChannel):
+            self.text_channels += delta
+        elif isinstance(channel, discord.VoiceChannel):
+            self.voice_channels += delta
+
+guild_stats_cache = {}  # guild_id -> GuildStats
+
+def guild_stats(guild: discord.Guild) -> GuildStats:
+    stats = guild_stats_cache.get(guild.id)
+    if stats is None:
+        stats = guild_stats_cache[guild.id] = GuildStats(guild)
+    return stats
+
+@bot.event
+async def on_guild_available(guild):
+    # The one full walk per guild; everything after is incremental
+    guild_stats_cache[guild.id] = GuildStats(guild)
+
+@bot.event
+async def on_guild_join(guild):
+    guild_stats_cache[guild.id] = GuildStats(guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    guild_stats_cache.pop(guild.id, None)
+
+# Updates only touch guilds already cached; an uncached guild is built from
+# the current state on first read, which already includes the change.
+@bot.event
+async def on_member_join(member):
+    stats = guild_stats_cache.get(member.guild.id)
+    if stats is not None and member.bot:
+        stats.bots += 1
+
+@bot.event
+async def on_member_remove(member):
+    stats = guild_stats_cache.get(member.guild.id)
+    if stats is not None and member.bot:
+        stats.bots -= 1
+
+@bot.event
+async def on_guild_channel_create(channel):
+    stats = guild_stats_cache.get(channel.guild.id)
+    if stats is not None:
+        stats.channel_delta(channel, 1)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    stats = guild_stats_cache.get(channel.guild.id)
+    if stats is not None:
+        stats.channel_delta(channel, -1)
+
+@bot.event
+async def on_guild_role_create(role):
+    stats = guild_stats_cache.get(role.guild.id)
+    if stats is not None:
+        stats.roles += 1
+
+@bot.event
+async def on_guild_role_delete(role):
+    stats = guild_stats_cache.get(role.guild.id)
+    if stats is not None:
+        stats.roles -= 1
 
 # ================= BASIC COMMANDS =================
 @bot.command()
@@ -504,7 +1825,7 @@ async def avatar(ctx, member: discord.Member = None):
     await ctx.send(embed=embed)
 
 @bot.command()
-async def userinfo(ctx, member: discord.Member = None):
+async def userinfo(ctx, member: CachedMember = None):
     """Menampilkan informasi user."""
     member = member or ctx.author
     roles = [role.mention for role in member.roles[1:]]  # Exclude @everyone
@@ -526,6 +1847,7 @@ async def userinfo(ctx, member: discord.Member = None):
 async def serverinfo(ctx):
     """Menampilkan informasi server."""
     guild = ctx.guild
+    stats = guild_stats(guild)
     
     embed = discord.Embed(
         title=f"🏠 Info Server - {guild.name}",
@@ -537,8 +1859,8 @@ async def serverinfo(ctx):
     embed.add_field(name="ID", value=guild.id, inline=True)
     embed.add_field(name="Dibuat", value=guild.created_at.strftime("%d/%m/%Y"), inline=True)
     embed.add_field(name="Members", value=guild.member_count, inline=True)
-    embed.add_field(name="Channels", value=len(guild.channels), inline=True)
-    embed.add_field(name="Roles", value=len(guild.roles), inline=True)
+    embed.add_field(name="Channels", value=f"{stats.channels} (💬 {stats.text_channels} • 🔊 {stats.voice_channels})", inline=True)
+    embed.add_field(name="Roles", value=stats.roles, inline=True)
     embed.add_field(name="Boost Level", value=guild.premium_tier, inline=True)
     embed.add_field(name="Boosts", value=guild.premium_subscription_count, inline=True)
     await ctx.send(embed=embed)
@@ -597,8 +1919,7 @@ async def reset_ai(ctx):
     await view.wait()
     
     if view.value is True:
-        if ctx.author.id in user_chats:
-            del user_chats[ctx.author.id]
+        delete_user_sessions(ctx.guild.id if ctx.guild else 0, ctx.author.id)
         await msg.edit(content="✅ Memory AI telah direset!", view=None)
     elif view.value is False:
         await msg.edit(content="❌ Dibatalkan.", view=None)
@@ -608,7 +1929,8 @@ async def reset_ai(ctx):
 @bot.command()
 async def aimodel(ctx):
     """Pilih model AI yang digunakan."""
-    info = GEMINI_MODELS[current_gemini_model]
+    guild_id = ctx.guild.id if ctx.guild else 0
+    info = GEMINI_MODELS[guild_model_key(guild_id, ctx.author.id)]
     embed = discord.Embed(
         title="🤖 AI Model Selector",
         description="Pilih model AI dari dropdown di bawah:",
@@ -616,8 +1938,8 @@ async def aimodel(ctx):
     )
     embed.add_field(name="Current Model", value=f"{info['emoji']} {info['name']}", inline=True)
     embed.add_field(name="Active Users", value=len(user_chats), inline=True)
-    embed.set_footer(text="Mengganti model akan reset memory AI")
-    await ctx.send(embed=embed, view=AIModelView())
+    embed.set_footer(text="Model dipilih per server" if guild_id else "Model dipilih per user di DM")
+    await ctx.send(embed=embed, view=AIModelView(guild_id, ctx.author.id))
 
 @bot.command()
 async def models(ctx):
@@ -627,8 +1949,9 @@ async def models(ctx):
         description="Model AI yang tersedia untuk digunakan:",
         color=discord.Color.blue()
     )
+    active_key = guild_model_key(ctx.guild.id if ctx.guild else 0, ctx.author.id)
     for key, info in GEMINI_MODELS.items():
-        status = "✅ Active" if key == current_gemini_model else ""
+        status = "✅ Active" if key == active_key else ""
         embed.add_field(
             name=f"{info['emoji']} {key.upper()} {status}",
             value=f"`{info['name']}`\n{info['description']}",
@@ -640,7 +1963,8 @@ async def models(ctx):
 # Slash commands for AI model
 @bot.tree.command(name="aimodel", description="Pilih model AI")
 async def aimodel_slash(interaction: discord.Interaction):
-    info = GEMINI_MODELS[current_gemini_model]
+    guild_id = interaction.guild_id or 0
+    info = GEMINI_MODELS[guild_model_key(guild_id, interaction.user.id)]
     embed = discord.Embed(
         title="🤖 AI Model Selector",
         description="Pilih model AI dari dropdown di bawah:",
@@ -648,8 +1972,8 @@ async def aimodel_slash(interaction: discord.Interaction):
     )
     embed.add_field(name="Current Model", value=f"{info['emoji']} {info['name']}", inline=True)
     embed.add_field(name="Active Users", value=len(user_chats), inline=True)
-    embed.set_footer(text="Mengganti model akan reset memory AI")
-    await interaction.response.send_message(embed=embed, view=AIModelView())
+    embed.set_footer(text="Model dipilih per server" if guild_id else "Model dipilih per user di DM")
+    await interaction.response.send_message(embed=embed, view=AIModelView(guild_id, interaction.user.id))
 
 # Slash command for menu
 @bot.tree.command(name="menu", description="Buka menu utama interaktif")
@@ -674,24 +1998,12 @@ async def ai(ctx, *, prompt: str):
     Chat dengan Gemini AI
     Contoh: !ai jelaskan shard discord
     """
-    try:
-        await ctx.typing()
-        chat = get_user_chat(ctx.author.id)  # ✅ AMBIL CHAT USER
-        response = chat.send_message(prompt)
-
-        await ctx.send(response.text[:2000])
-    except Exception as e:
-        await ctx.send("❌ Terjadi error saat memproses AI.")
+    await dispatch_ai(ctx, prompt)
 
 # ================= SLASH COMMAND =================
 @bot.tree.command(name="ai", description="Chat dengan Gemini AI")
 async def ai_slash(interaction: discord.Interaction, prompt: str):
-    try:
-        await interaction.response.defer(thinking=True)
-        response = chat.send_message(prompt)
-        await interaction.followup.send(response.text[:2000])
-    except Exception:
-        await interaction.followup.send("❌ Terjadi error pada AI.")
+    await dispatch_ai(interaction, prompt)
 
 @bot.tree.command(name="avatar", description="Lihat avatar user")
 async def avatar_slash(interaction: discord.Interaction, member: discord.Member = None):
@@ -724,6 +2036,7 @@ async def userinfo_slash(interaction: discord.Interaction, member: discord.Membe
 @bot.tree.command(name="serverinfo", description="Lihat info server")
 async def serverinfo_slash(interaction: discord.Interaction):
     guild = interaction.guild
+    stats = guild_stats(guild)
     
     embed = discord.Embed(
         title=f"🏠 Info Server - {guild.name}",
@@ -735,15 +2048,24 @@ async def serverinfo_slash(interaction: discord.Interaction):
     embed.add_field(name="ID", value=guild.id, inline=True)
     embed.add_field(name="Dibuat", value=guild.created_at.strftime("%d/%m/%Y"), inline=True)
     embed.add_field(name="Members", value=guild.member_count, inline=True)
-    embed.add_field(name="Channels", value=len(guild.channels), inline=True)
-    embed.add_field(name="Roles", value=len(guild.roles), inline=True)
+    embed.add_field(name="Channels", value=f"{stats.channels} (💬 {stats.text_channels} • 🔊 {stats.voice_channels})", inline=True)
+    embed.add_field(name="Roles", value=stats.roles, inline=True)
     await interaction.response.send_message(embed=embed)
 
 # ================= MODERATION =================
+# Shared by the moderation commands and auto-mod
+async def kick_member(member: discord.Member, reason: str):
+    await member.kick(reason=reason)
+
+async def purge_messages(channel, limit: int, check=None) -> list:
+    if check is None:
+        return await channel.purge(limit=limit)
+    return await channel.purge(limit=limit, check=check)
+
 @bot.command()
 @commands.has_permissions(kick_members=True)
 async def kick(ctx, member: discord.Member, *, reason="Tidak ada alasan"):
-    await member.kick(reason=reason)
+    await kick_member(member, reason)
     await ctx.send(f"{member.mention} telah di-kick.\nAlasan: {reason}")
 
 @bot.command()
@@ -759,7 +2081,7 @@ async def clear(ctx, amount: int):
         await ctx.send("❌ Jumlah harus antara 1-100.")
         return
     
-    deleted = await ctx.channel.purge(limit=amount + 1)  # +1 untuk hapus command juga
+    deleted = await purge_messages(ctx.channel, amount + 1)  # +1 untuk hapus command juga
     msg = await ctx.send(f"✅ Berhasil menghapus {len(deleted) - 1} pesan.")
     await asyncio.sleep(3)
     await msg.delete()
@@ -882,6 +2204,26 @@ async def rps(ctx, choice: str):
     embed.add_field(name="Hasil", value=result, inline=False)
     await ctx.send(embed=embed)
 
+# ================= USER PROFILE CACHE =================
+# Banners and accent colours only come from REST, so full users are cached
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
+
+user_profiles = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+user_fetches = SingleFlight()
+
+async def fetch_user_profile(user_id: int) -> discord.User:
+    """Full user from the cache; concurrent misses for one id share a single fetch_user."""
+    user = user_profiles.get(user_id)
+    if user is not None:
+        return user
+    inflight = user_fetches.get(user_id)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+    user = await user_fetches.run(user_id, bot.fetch_user, user_id)
+    user_profiles.put(user_id, user)
+    return user
+
 # ================= UTILITY COMMANDS =================
 @bot.command()
 async def timer(ctx, duration: str):
@@ -903,9 +2245,17 @@ async def timer(ctx, duration: str):
         await ctx.send("❌ Maksimal 24 jam.")
         return
     
-    await ctx.send(f"⏰ Timer set untuk **{amount} {unit_name}**!")
-    await asyncio.sleep(seconds)
-    await ctx.send(f"🔔 {ctx.author.mention} Timer **{amount} {unit_name}** sudah selesai!")
+    job = job_scheduler.schedule(
+        "timer", seconds, ctx.guild.id if ctx.guild else 0, ctx.channel.id, ctx.author.id,
+        label=f"{amount} {unit_name}"
+    )
+    await ctx.send(f"⏰ Timer set untuk **{amount} {unit_name}**! (ID: `{job.job_id}`)")
+
+@job_scheduler.handler("timer")
+async def fire_timer(job):
+    channel = await resolve_channel(job.channel_id)
+    if channel is not None:
+        await channel.send(f"🔔 <@{job.user_id}> Timer **{job.payload['label']}** sudah selesai!")
 
 @bot.command()
 async def math(ctx, *, expression: str):
@@ -949,14 +2299,11 @@ async def embed(ctx, title: str, *, description: str):
 @bot.command()
 async def afk(ctx, *, reason: str = "AFK"):
     """Set status AFK."""
-    afk_users[ctx.author.id] = {
-        "reason": reason,
-        "time": datetime.datetime.now()
-    }
+    afk_registry.set(ctx.author.id, reason)
     await ctx.send(f"💤 {ctx.author.mention} sekarang AFK: **{reason}**")
 
 @bot.command()
-async def whois(ctx, member: discord.Member = None):
+async def whois(ctx, member: CachedMember = None):
     """Info lengkap tentang user."""
     member = member or ctx.author
     
@@ -1003,15 +2350,16 @@ async def membercount(ctx):
     """Tampilkan jumlah member server."""
     guild = ctx.guild
     total = guild.member_count
-    bots = len([m for m in guild.members if m.bot])
-    humans = total - bots
     
     embed = discord.Embed(
         title=f"👥 Member Count - {guild.name}",
         color=discord.Color.blue()
     )
-    embed.add_field(name="👤 Manusia", value=humans, inline=True)
-    embed.add_field(name="🤖 Bot", value=bots, inline=True)
+    # Bots are counted from the member cache, which is only complete on the full profile
+    if MEMBER_CACHE_PROFILE == "full":
+        bots = guild_stats(guild).bots
+        embed.add_field(name="👤 Manusia", value=total - bots, inline=True)
+        embed.add_field(name="🤖 Bot", value=bots, inline=True)
     embed.add_field(name="📊 Total", value=total, inline=True)
     await ctx.send(embed=embed)
 
@@ -1034,7 +2382,7 @@ async def servericon(ctx):
 async def banner(ctx, member: discord.Member = None):
     """Tampilkan banner user."""
     member = member or ctx.author
-    user = await bot.fetch_user(member.id)  # Fetch full user to get banner
+    user = await fetch_user_profile(member.id)  # Full user to get banner
     
     if not user.banner:
         await ctx.send(f"❌ {member.display_name} tidak memiliki banner.")
@@ -1048,7 +2396,161 @@ async def banner(ctx, member: discord.Member = None):
     await ctx.send(embed=embed)
 
 # ================= LEVELING SYSTEM =================
-user_xp = {}
+db.execute(
+    "CREATE TABLE IF NOT EXISTS user_xp ("
+    "guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, xp INTEGER NOT NULL, "
+    "PRIMARY KEY (guild_id, user_id))"
+)
+xp_writer = WriteBehind(
+    "INSERT OR REPLACE INTO user_xp (guild_id, user_id, xp) VALUES (?, ?, ?)",
+    "DELETE FROM user_xp WHERE guild_id = ? AND user_id = ?"
+)
+write_behind_queues.append(xp_writer)
+
+XP_MAX = 2 ** 32 - 1  # XP column is array('I')
+
+class GuildXP:
+    """Compact XP storage and ranking for one guild.
+
+    Rows live in parallel append-only columns, `ids` (array('Q')) and `xp`
+    (array('I')), addressed by slot number. Two array('I') indexes of slots
+    replace any per-member Python objects:
+
+    - `by_id` is sorted by member id and is searched with bisect;
+    - `order` is sorted by (xp desc, id asc), so a slot's position is its
+      rank and a leaderboard page is a slice.
+
+    That is 20 bytes per member. Lookups are O(log n); an XP change moves
+    one slot inside `order`, which is a memmove rather than a re-sort.
+    """
+
+    __slots__ = ("ids", "xp", "by_id", "order")
+
+    def __init__(self, rows=()):
+        self.ids = array("Q", (user_id for user_id, _ in rows))
+        self.xp = array("I", (min(xp, XP_MAX) for _, xp in rows))
+        slots = range(len(self.ids))
+        self.by_id = array("I", sorted(slots, key=self.ids.__getitem__))
+        self.order = array("I", sorted(slots, key=self._rank_key))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _rank_key(self, slot: int) -> tuple:
+        return -self.xp[slot], self.ids[slot]
+
+    def _slot(self, user_id: int):
+        pos = bisect.bisect_left(self.by_id, user_id, key=self.ids.__getitem__)
+        if pos < len(self.by_id) and self.ids[self.by_id[pos]] == user_id:
+            return self.by_id[pos]
+        return None
+
+    def get(self, user_id: int):
+        slot = self._slot(user_id)
+        return self.xp[slot] if slot is not None else None
+
+    def add(self, user_id: int, amount: int) -> int:
+        slot = self._slot(user_id)
+        if slot is None:
+            slot = len(self.ids)
+            self.ids.append(user_id)
+            self.xp.append(0)
+            self.by_id.insert(bisect.bisect_left(self.by_id, user_id, key=self.ids.__getitem__), slot)
+        else:
+            del self.order[self.position(user_id, slot)]
+        xp = self.xp[slot] = min(self.xp[slot] + amount, XP_MAX)
+        self.order.insert(bisect.bisect_left(self.order, (-xp, user_id), key=self._rank_key), slot)
+        return xp
+
+    def position(self, user_id: int, slot: int = None):
+        """0-based rank of a member, None if they have no XP."""
+        if slot is None:
+            slot = self._slot(user_id)
+            if slot is None:
+                return None
+        return bisect.bisect_left(self.order, (-self.xp[slot], user_id), key=self._rank_key)
+
+    def top(self, start: int, count: int) -> list:
+        """[(user_id, xp)] ranked from 0-based position `start`."""
+        return [(self.ids[slot], self.xp[slot]) for slot in self.order[start:start + count]]
+
+    def snapshot(self) -> tuple:
+        """Point-in-time copy of the columns (a memcpy, safe to hand to a thread)."""
+        return array("Q", self.ids), array("I", self.xp)
+
+    @staticmethod
+    def export_csv(snapshot: tuple) -> bytes:
+        ids, xp = snapshot
+        lines = ["user_id,xp"]
+        lines.extend(f"{user_id},{value}" for user_id, value in zip(ids, xp))
+        return ("\n".join(lines) + "\n").encode()
+
+class XPStore:
+    """Per-guild XP totals held in memory and persisted with write-behind.
+
+    A guild is loaded from SQLite the first time it is used. After that
+    `add` is an array update plus a queued row, with no disk I/O; changes
+    for the same member are coalesced until the next batched flush.
+    """
+
+    def __init__(self):
+        self._guilds = {}   # guild_id -> GuildXP
+        self._loading = {}  # guild_id -> asyncio.Task
+
+    @staticmethod
+    def _select(guild_id: int):
+        return db.execute("SELECT user_id, xp FROM user_xp WHERE guild_id = ?", (guild_id,)).fetchall()
+
+    async def ensure_loaded(self, guild_id: int):
+        if guild_id in self._guilds:
+            return
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = self._loading[guild_id] = asyncio.create_task(self._load(guild_id))
+        await asyncio.shield(task)
+
+    async def _load(self, guild_id: int):
+        try:
+            rows = await run_db(self._select, guild_id)
+            self._guilds[guild_id] = GuildXP(rows)
+        finally:
+            self._loading.pop(guild_id, None)
+
+    def get(self, guild_id: int, user_id: int) -> int:
+        guild = self._guilds.get(guild_id)
+        return (guild.get(user_id) or 0) if guild else 0
+
+    def add(self, guild_id: int, user_id: int, amount: int) -> int:
+        """Add XP to a member of a loaded guild and return the new total."""
+        xp = self._guilds[guild_id].add(user_id, amount)
+        xp_writer.put((guild_id, user_id), (guild_id, user_id, xp))
+        return xp
+
+    def count(self, guild_id: int) -> int:
+        guild = self._guilds.get(guild_id)
+        return len(guild) if guild else 0
+
+    def rank_of(self, guild_id: int, user_id: int):
+        """1-based server position of a member, None if they have no XP."""
+        guild = self._guilds.get(guild_id)
+        position = guild.position(user_id) if guild else None
+        return position + 1 if position is not None else None
+
+    def top(self, guild_id: int, start: int = 0, count: int = 10) -> list:
+        """[(user_id, xp)] ranked from 0-based position `start`."""
+        guild = self._guilds.get(guild_id)
+        return guild.top(start, count) if guild else []
+
+    def snapshot(self, guild_id: int):
+        guild = self._guilds.get(guild_id)
+        return guild.snapshot() if guild else (array("Q"), array("I"))
+
+xp_store = XPStore()
+
+async def add_xp(guild_id: int, user_id: int, amount: int) -> int:
+    """Give XP to a member (guild 0 = DMs) and return the new total."""
+    await xp_store.ensure_loaded(guild_id)
+    return xp_store.add(guild_id, user_id, amount)
 
 def get_level(xp: int) -> int:
     """Calculate level from XP."""
@@ -1062,7 +2564,9 @@ def xp_for_level(level: int) -> int:
 async def rank(ctx, member: discord.Member = None):
     """Lihat level dan XP user."""
     member = member or ctx.author
-    xp = user_xp.get(member.id, 0)
+    guild_id = ctx.guild.id if ctx.guild else 0
+    await xp_store.ensure_loaded(guild_id)
+    xp = xp_store.get(guild_id, member.id)
     level = get_level(xp)
     next_level_xp = xp_for_level(level + 1)
     progress = (xp - xp_for_level(level)) / (next_level_xp - xp_for_level(level)) * 100
@@ -1079,17 +2583,41 @@ async def rank(ctx, member: discord.Member = None):
     embed.set_thumbnail(url=member.display_avatar.url)
     embed.add_field(name="⭐ Level", value=level, inline=True)
     embed.add_field(name="✨ XP", value=f"{xp}/{next_level_xp}", inline=True)
+    position = xp_store.rank_of(guild_id, member.id)
+    embed.add_field(
+        name="🏆 Server Rank",
+        value=f"#{position}/{xp_store.count(guild_id)}" if position else "-",
+        inline=True
+    )
     embed.add_field(name="📈 Progress", value=f"{bar} {progress:.1f}%", inline=False)
     await ctx.send(embed=embed)
 
 @bot.command()
-async def leaderboard(ctx):
-    """Tampilkan leaderboard XP."""
-    if not user_xp:
+@commands.has_permissions(manage_guild=True)
+async def xpexport(ctx):
+    """Export data XP server ini ke file CSV."""
+    await xp_store.ensure_loaded(ctx.guild.id)
+    snapshot = xp_store.snapshot(ctx.guild.id)
+    data = await asyncio.to_thread(GuildXP.export_csv, snapshot)
+    await ctx.send(
+        f"📦 Data XP **{ctx.guild.name}** ({len(snapshot[0])} member)",
+        file=discord.File(io.BytesIO(data), filename=f"xp_{ctx.guild.id}.csv")
+    )
+
+LEADERBOARD_PAGE_SIZE = 10
+
+@bot.command()
+async def leaderboard(ctx, page: int = 1):
+    """Tampilkan leaderboard XP. Contoh: /leaderboard 2"""
+    await xp_store.ensure_loaded(ctx.guild.id)
+    total = xp_store.count(ctx.guild.id)
+    if not total:
         await ctx.send("❌ Belum ada data XP.")
         return
     
-    sorted_users = sorted(user_xp.items(), key=lambda x: x[1], reverse=True)[:10]
+    pages = (total + LEADERBOARD_PAGE_SIZE - 1) // LEADERBOARD_PAGE_SIZE
+    page = max(1, min(page, pages))
+    start = (page - 1) * LEADERBOARD_PAGE_SIZE
     
     embed = discord.Embed(
         title="🏆 XP Leaderboard",
@@ -1098,91 +2626,262 @@ async def leaderboard(ctx):
     
     medals = ["🥇", "🥈", "🥉"]
     description = ""
-    for i, (user_id, xp) in enumerate(sorted_users):
-        member = ctx.guild.get_member(user_id)
-        if member:
-            medal = medals[i] if i < 3 else f"**{i+1}.**"
-            level = get_level(xp)
-            description += f"{medal} {member.display_name} - Level {level} ({xp} XP)\n"
+    rows = xp_store.top(ctx.guild.id, start, LEADERBOARD_PAGE_SIZE)
+    members = await resolve_members(ctx.guild, [user_id for user_id, _ in rows])
+    for i, (user_id, xp) in enumerate(rows, start=start):
+        member = members.get(user_id)
+        name = member.display_name if member else f"<@{user_id}>"
+        medal = medals[i] if i < 3 else f"**{i+1}.**"
+        level = get_level(xp)
+        description += f"{medal} {name} - Level {level} ({xp} XP)\n"
     
     embed.description = description or "Tidak ada data"
+    embed.set_footer(text=f"Halaman {page}/{pages} • {total} member")
     await ctx.send(embed=embed)
 
 # ================= GIVEAWAY SYSTEM =================
-active_giveaways = {}
+GIVEAWAY_EDIT_INTERVAL = float(os.getenv("GIVEAWAY_EDIT_INTERVAL", "5"))  # Min seconds between join-count edits
+GIVEAWAY_MAX_WINNERS = 20
+GIVEAWAY_END_RETRIES = 6  # Attempts to reach an unavailable guild before giving up
+GIVEAWAY_END_RETRY_DELAY = 600  # Seconds between those attempts
+GIVEAWAY_READY_RETRY_DELAY = 5  # Seconds between checks while the bot is still starting up
+
+db.execute(
+    "CREATE TABLE IF NOT EXISTS giveaways ("
+    "message_id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, "
+    "host_id INTEGER NOT NULL, prize TEXT NOT NULL, winners INTEGER NOT NULL, ends_at REAL NOT NULL)"
+)
+db.execute(
+    "CREATE TABLE IF NOT EXISTS giveaway_entries ("
+    "message_id INTEGER NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (message_id, user_id))"
+)
+giveaway_writer = WriteBehind(
+    "INSERT OR REPLACE INTO giveaways "
+    "(message_id, guild_id, channel_id, host_id, prize, winners, ends_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    "DELETE FROM giveaways WHERE message_id = ?"
+)
+entry_writer = WriteBehind(
+    "INSERT OR REPLACE INTO giveaway_entries (message_id, user_id) VALUES (?, ?)",
+    "DELETE FROM giveaway_entries WHERE message_id = ? AND user_id = ?"
+)
+write_behind_queues.extend((giveaway_writer, entry_writer))
 
-class GiveawayView(ui.View):
-    def __init__(self, prize: str, host_id: int, ends_at: datetime.datetime):
-        super().__init__(timeout=None)
-        self.prize = prize
+class Giveaway:
+    """A running giveaway; entrants are kept as a list for drawing plus a set for lookups."""
+
+    __slots__ = ("message_id", "guild_id", "channel_id", "host_id", "prize", "winners", "ends_at",
+                 "entrants", "entrant_ids", "label_task", "last_edit")
+
+    def __init__(self, message_id, guild_id, channel_id, host_id, prize, winners, ends_at):
+        self.message_id = message_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
         self.host_id = host_id
+        self.prize = prize
+        self.winners = winners
         self.ends_at = ends_at
-        self.participants = set()
-    
-    @ui.button(label="🎉 Join Giveaway", style=discord.ButtonStyle.green)
+        self.entrants = []
+        self.entrant_ids = set()
+        self.label_task = None
+        self.last_edit = 0.0
+
+    def row(self) -> tuple:
+        return (self.message_id, self.guild_id, self.channel_id, self.host_id,
+                self.prize, self.winners, self.ends_at)
+
+    def join(self, user_id: int) -> bool:
+        if user_id in self.entrant_ids:
+            return False
+        self.entrant_ids.add(user_id)
+        self.entrants.append(user_id)
+        return True
+
+    def draw(self, count: int, start: int = 0) -> list:
+        """Pick `count` more distinct entrants with a partial Fisher-Yates shuffle, O(count).
+
+        `start` is how many were drawn before, so redraws never repeat a pick.
+        """
+        pool = self.entrants
+        picked = []
+        for i in range(start, min(start + count, len(pool))):
+            j = random.randrange(i, len(pool))
+            pool[i], pool[j] = pool[j], pool[i]
+            picked.append(pool[i])
+        return picked
+
+active_giveaways = {}  # message_id -> Giveaway
+
+for row in db.execute(
+    "SELECT message_id, guild_id, channel_id, host_id, prize, winners, ends_at FROM giveaways"
+):
+    active_giveaways[row[0]] = Giveaway(*row)
+for message_id, user_id in db.execute("SELECT message_id, user_id FROM giveaway_entries"):
+    if message_id in active_giveaways:
+        active_giveaways[message_id].join(user_id)
+
+class GiveawayView(ui.View):
+    """Persistent join button; one registered instance serves every giveaway by message id."""
+
+    def __init__(self, count: int = 0):
+        super().__init__(timeout=None)
+        if count:
+            self.join.label = f"🎉 Join ({count})"
+
+    @classmethod
+    def render(cls, count: int = 0) -> "GiveawayView":
+        """Button layout for a send/edit. It is stopped so discord.py doesn't store
+        it per message; clicks go to the persistent instance via custom_id."""
+        view = cls(count)
+        view.stop()
+        return view
+
+    @ui.button(label="🎉 Join Giveaway", style=discord.ButtonStyle.green, custom_id="giveaway:join")
     async def join(self, interaction: discord.Interaction, button: ui.Button):
-        if interaction.user.id in self.participants:
+        giveaway = active_giveaways.get(interaction.message.id)
+        if giveaway is None:
+            await interaction.response.send_message("❌ Giveaway ini sudah berakhir.", ephemeral=True)
+            return
+        if not giveaway.join(interaction.user.id):
             await interaction.response.send_message("❌ Kamu sudah bergabung!", ephemeral=True)
             return
-        
-        self.participants.add(interaction.user.id)
-        button.label = f"🎉 Join ({len(self.participants)})"
-        await interaction.response.edit_message(view=self)
-        await interaction.followup.send("✅ Berhasil bergabung giveaway!", ephemeral=True)
+
+        entry_writer.put((giveaway.message_id, interaction.user.id), (giveaway.message_id, interaction.user.id))
+        if giveaway.label_task is None:
+            giveaway.label_task = asyncio.create_task(update_giveaway_label(giveaway))
+        await interaction.response.send_message("✅ Berhasil bergabung giveaway!", ephemeral=True)
+
+async def update_giveaway_label(giveaway: Giveaway):
+    """Coalesce join-count edits so each message is edited at most once per interval."""
+    await asyncio.sleep(max(0.0, giveaway.last_edit + GIVEAWAY_EDIT_INTERVAL - time.monotonic()))
+    giveaway.last_edit = time.monotonic()
+    count = len(giveaway.entrants)
+    # Joins from here on aren't in this edit, so they must schedule the next one
+    giveaway.label_task = None
+    message = bot.get_partial_messageable(giveaway.channel_id).get_partial_message(giveaway.message_id)
+    try:
+        await message.edit(view=GiveawayView.render(count))
+    except discord.HTTPException as e:
+        print(f"Giveaway label edit error: {e}")
+
+class WinnerCount(commands.Converter):
+    """Winner count written as `<n>w`, e.g. `3w`."""
+
+    async def convert(self, ctx, argument: str) -> int:
+        match = re.fullmatch(r"(\d+)w", argument.lower())
+        if not match:
+            raise commands.BadArgument("Bukan jumlah pemenang")
+        return int(match.group(1))
 
 @bot.command()
 @commands.has_permissions(manage_guild=True)
-async def giveaway(ctx, duration: str, *, prize: str):
-    """Buat giveaway. Contoh: /giveaway 1h Nitro Classic"""
-    match = re.match(r"(\d+)([smh])", duration.lower())
+async def giveaway(ctx, duration: str, winners: Optional[WinnerCount] = 1, *, prize: str):
+    """Buat giveaway. Contoh: /giveaway 1h Nitro Classic, /giveaway 1d 3w Nitro"""
+    match = re.match(r"(\d+)([smhd])", duration.lower())
     if not match:
-        await ctx.send("❌ Format durasi: `<angka><s/m/h>`")
+        await ctx.send("❌ Format durasi: `<angka><s/m/h/d>`")
         return
     
     amount = int(match.group(1))
     unit = match.group(2)
-    units = {"s": 1, "m": 60, "h": 3600}
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
     seconds = amount * units[unit]
     
     if seconds > 604800:  # Max 7 days
         await ctx.send("❌ Maksimal 7 hari.")
         return
+    if not 1 <= winners <= GIVEAWAY_MAX_WINNERS:
+        await ctx.send(f"❌ Jumlah pemenang harus 1-{GIVEAWAY_MAX_WINNERS}.")
+        return
     
-    ends_at = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
-    view = GiveawayView(prize, ctx.author.id, ends_at)
+    ends_at = time.time() + seconds
     
     embed = discord.Embed(
         title="🎉 GIVEAWAY 🎉",
         description=f"**Hadiah:** {prize}\n\n"
                     f"**Host:** {ctx.author.mention}\n"
-                    f"**Berakhir:** <t:{int(ends_at.timestamp())}:R>\n\n"
+                    f"**Pemenang:** {winners}\n"
+                    f"**Berakhir:** <t:{int(ends_at)}:R>\n\n"
                     f"Klik tombol di bawah untuk ikut!",
         color=discord.Color.gold()
     )
     embed.set_footer(text=f"Giveaway ID: {ctx.message.id}")
     
-    msg = await ctx.send(embed=embed, view=view)
-    active_giveaways[msg.id] = view
-    
-    # Wait and end giveaway
-    await asyncio.sleep(seconds)
-    
-    if msg.id in active_giveaways:
-        view = active_giveaways.pop(msg.id)
-        if not view.participants:
-            await ctx.send("😢 Tidak ada peserta giveaway.")
-        else:
-            winner_id = random.choice(list(view.participants))
-            winner = ctx.guild.get_member(winner_id)
-            
-            embed = discord.Embed(
-                title="🎊 GIVEAWAY ENDED 🎊",
-                description=f"**Hadiah:** {prize}\n\n"
-                            f"🏆 **Pemenang:** {winner.mention}\n"
-                            f"Selamat! 🎉",
-                color=discord.Color.green()
+    msg = await ctx.send(embed=embed, view=GiveawayView.render())
+    giveaway = Giveaway(msg.id, ctx.guild.id, ctx.channel.id, ctx.author.id, prize, winners, ends_at)
+    active_giveaways[msg.id] = giveaway
+    giveaway_writer.put(msg.id, giveaway.row())
+    job_scheduler.schedule(
+        "giveaway_end", seconds, ctx.guild.id, ctx.channel.id, ctx.author.id,
+        message_id=msg.id, prize=prize
+    )
+
+def discard_giveaway(giveaway: Giveaway):
+    active_giveaways.pop(giveaway.message_id, None)
+    if giveaway.label_task is not None:
+        giveaway.label_task.cancel()
+    giveaway_writer.delete(giveaway.message_id)
+    for user_id in giveaway.entrants:
+        entry_writer.delete((giveaway.message_id, user_id))
+
+@job_scheduler.handler("giveaway_end")
+async def end_giveaway(job):
+    # Overdue jobs fire from setup_hook, before guilds are in the cache. Check
+    # again shortly rather than waiting here, so entries aren't lost to a
+    # missing guild and no handler sits idle until READY.
+    if not bot.is_ready():
+        job_scheduler.schedule(
+            "giveaway_end", GIVEAWAY_READY_RETRY_DELAY, job.guild_id, job.channel_id, job.user_id, **job.payload
+        )
+        return
+
+    giveaway = active_giveaways.get(job.payload["message_id"])
+    guild = bot.get_guild(job.guild_id)
+    channel = await resolve_channel(job.channel_id)
+    if guild is None or channel is None:
+        # Keep the entries and try again later; give up only after several attempts
+        attempts = job.payload.get("attempts", 0) + 1
+        if attempts <= GIVEAWAY_END_RETRIES:
+            job_scheduler.schedule(
+                "giveaway_end", GIVEAWAY_END_RETRY_DELAY, job.guild_id, job.channel_id, job.user_id,
+                **{**job.payload, "attempts": attempts}
             )
-            await ctx.send(embed=embed)
+        elif giveaway is not None:
+            discard_giveaway(giveaway)
+        return
+
+    # Drop the join button now that the giveaway is over
+    try:
+        await channel.get_partial_message(job.payload["message_id"]).edit(view=None)
+    except discord.HTTPException:
+        pass
+
+    # Redraw in place of winners who already left the server
+    winners = []
+    drawn = 0
+    while giveaway is not None and len(winners) < giveaway.winners:
+        batch = giveaway.draw(giveaway.winners - len(winners), start=drawn)
+        if not batch:
+            break
+        drawn += len(batch)
+        members = await resolve_members(guild, batch)
+        winners.extend(members[user_id] for user_id in batch if user_id in members)
+
+    if giveaway is not None:
+        discard_giveaway(giveaway)  # Only once the draw has happened
+
+    if not winners:
+        await channel.send("😢 Tidak ada peserta giveaway.")
+        return
+
+    embed = discord.Embed(
+        title="🎊 GIVEAWAY ENDED 🎊",
+        description=f"**Hadiah:** {job.payload['prize']}\n\n"
+                    f"🏆 **Pemenang:** {', '.join(winner.mention for winner in winners)}\n"
+                    f"Selamat! 🎉",
+        color=discord.Color.green()
+    )
+    embed.set_footer(text=f"Total peserta: {len(giveaway.entrants)}")
+    await channel.send(embed=embed)
 
 # ================= REMINDER SYSTEM =================
 @bot.command()
@@ -1203,7 +2902,10 @@ async def remind(ctx, time: str, *, message: str):
         await ctx.send("❌ Maksimal 7 hari.")
         return
     
-    remind_time = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    job = job_scheduler.schedule(
+        "remind", seconds, ctx.guild.id if ctx.guild else 0, ctx.channel.id, ctx.author.id,
+        message=message
+    )
     
     embed = discord.Embed(
         title="⏰ Reminder Set",
@@ -1211,19 +2913,56 @@ async def remind(ctx, time: str, *, message: str):
         color=discord.Color.blue()
     )
     embed.add_field(name="📝 Pesan", value=message, inline=False)
-    embed.add_field(name="🕐 Waktu", value=f"<t:{int(remind_time.timestamp())}:R>", inline=False)
+    embed.add_field(name="🕐 Waktu", value=f"<t:{int(job.due_at)}:R>", inline=False)
+    embed.set_footer(text=f"ID: {job.job_id} • /cancelremind {job.job_id} untuk membatalkan")
     await ctx.send(embed=embed)
-    
-    await asyncio.sleep(seconds)
-    
+
+@job_scheduler.handler("remind")
+async def fire_reminder(job):
+    channel = await resolve_channel(job.channel_id)
+    if channel is None:
+        return
     remind_embed = discord.Embed(
         title="🔔 Reminder!",
-        description=message,
+        description=job.payload["message"],
         color=discord.Color.gold(),
         timestamp=datetime.datetime.now()
     )
     remind_embed.set_footer(text="Reminder yang kamu set")
-    await ctx.send(f"{ctx.author.mention}", embed=remind_embed)
+    await channel.send(f"<@{job.user_id}>", embed=remind_embed)
+
+@bot.command()
+async def reminders(ctx):
+    """Lihat timer & reminder yang masih berjalan"""
+    jobs = job_scheduler.pending(ctx.author.id, ("timer", "remind"))
+    if not jobs:
+        await ctx.send("📭 Kamu tidak punya timer atau reminder aktif.")
+        return
+
+    lines = []
+    for job in jobs[:15]:
+        text = job.payload.get("message") or f"Timer {job.payload.get('label', '')}"
+        if len(text) > 50:
+            text = text[:47] + "..."
+        lines.append(f"`{job.job_id}` • <t:{int(job.due_at)}:R> • {text}")
+
+    embed = discord.Embed(
+        title="⏰ Reminder Aktif",
+        description="\n".join(lines),
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Total: {len(jobs)} • /cancelremind <id> untuk membatalkan")
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def cancelremind(ctx, job_id: int):
+    """Batalkan timer atau reminder. Contoh: /cancelremind 12"""
+    job = job_scheduler.jobs.get(job_id)
+    if job is None or job.user_id != ctx.author.id or job.kind not in ("timer", "remind"):
+        await ctx.send("❌ Reminder tidak ditemukan.")
+        return
+    job_scheduler.cancel(job_id)
+    await ctx.send(f"✅ Reminder `{job_id}` dibatalkan.")
 
 # ================= TRIVIA GAME =================
 trivia_questions = [
@@ -1273,7 +3012,7 @@ class TriviaView(ui.View):
             
             if correct:
                 # Give XP
-                user_xp[interaction.user.id] = user_xp.get(interaction.user.id, 0) + 25
+                await add_xp(interaction.guild_id or 0, interaction.user.id, 25)
                 result_text = "✅ **Benar!** +25 XP"
                 color = discord.Color.green()
             else:
@@ -1337,7 +3076,7 @@ async def scramble(ctx):
     try:
         msg = await bot.wait_for('message', check=check, timeout=30)
         if msg.content.lower() == word:
-            user_xp[ctx.author.id] = user_xp.get(ctx.author.id, 0) + 20
+            await add_xp(ctx.guild.id if ctx.guild else 0, ctx.author.id, 20)
             await ctx.send(f"🎉 **Benar!** Jawabannya adalah `{word}`. +20 XP!")
         else:
             await ctx.send(f"❌ **Salah!** Jawabannya adalah `{word}`.")
@@ -1345,74 +3084,523 @@ async def scramble(ctx):
         await ctx.send(f"⏰ **Waktu habis!** Jawabannya adalah `{word}`.")
 
 # ================= COUNTING GAME =================
-counting_channels = {}
+COUNTING_REACTION_INTERVAL = float(os.getenv("COUNTING_REACTION_INTERVAL", "0.35"))  # Seconds between reactions per channel
+COUNTING_REACTION_BACKLOG = 50  # Oldest pending reactions are dropped beyond this
+
+db.execute(
+    "CREATE TABLE IF NOT EXISTS counting_channels ("
+    "channel_id INTEGER PRIMARY KEY, count INTEGER NOT NULL, "
+    "last_user_id INTEGER NOT NULL, best INTEGER NOT NULL)"
+)
+counting_writer = WriteBehind(
+    "INSERT OR REPLACE INTO counting_channels (channel_id, count, last_user_id, best) VALUES (?, ?, ?, ?)",
+    "DELETE FROM counting_channels WHERE channel_id = ?"
+)
+write_behind_queues.append(counting_writer)
+
+class CountingState:
+    """Progress of one counting channel (last_user_id 0 = nobody yet)."""
+
+    __slots__ = ("channel_id", "count", "last_user_id", "best")
+
+    def __init__(self, channel_id, count=0, last_user_id=0, best=0):
+        self.channel_id = channel_id
+        self.count = count
+        self.last_user_id = last_user_id
+        self.best = best
+
+    def advance(self, user_id: int, number: int):
+        """Compare-and-advance; returns None on success or the reason the count broke.
+
+        Never awaits, so two messages can't both read the same count.
+        """
+        if number != self.count + 1:
+            reason = "wrong"
+        elif user_id == self.last_user_id:
+            reason = "twice"
+        else:
+            self.count = number
+            self.last_user_id = user_id
+            self.best = max(self.best, number)
+            counting_writer.put(self.channel_id, self.row())
+            return None
+
+        self.count = 0
+        self.last_user_id = 0
+        counting_writer.put(self.channel_id, self.row())
+        return reason
+
+    def row(self) -> tuple:
+        return (self.channel_id, self.count, self.last_user_id, self.best)
+
+counting_channels = {
+    row[0]: CountingState(*row)
+    for row in db.execute("SELECT channel_id, count, last_user_id, best FROM counting_channels")
+}
+
+class ReactionQueue:
+    """Paces reactions per channel so fast counting stays under Discord's reaction limit."""
+
+    def __init__(self, interval: float, backlog: int):
+        self.interval = interval
+        self.backlog = backlog
+        self._queues = {}  # channel_id -> deque of (message, emoji)
+        self._tasks = {}   # channel_id -> drain task
+
+    def add(self, message, emoji: str):
+        queue = self._queues.get(message.channel.id)
+        if queue is None:
+            queue = self._queues[message.channel.id] = deque(maxlen=self.backlog)
+            self._tasks[message.channel.id] = asyncio.create_task(self._drain(message.channel.id, queue))
+        queue.append((message, emoji))
+
+    async def _drain(self, channel_id: int, queue: deque):
+        try:
+            while queue:
+                message, emoji = queue.popleft()
+                try:
+                    await message.add_reaction(emoji)
+                except discord.HTTPException as e:
+                    print(f"Reaction error: {e}")
+                await asyncio.sleep(self.interval)
+        finally:
+            del self._queues[channel_id]
+            del self._tasks[channel_id]
+
+counting_reactions = ReactionQueue(COUNTING_REACTION_INTERVAL, COUNTING_REACTION_BACKLOG)
 
 @bot.command()
 @commands.has_permissions(manage_channels=True)
 async def setcount(ctx):
     """Set channel ini sebagai counting channel."""
-    counting_channels[ctx.channel.id] = 0
+    state = counting_channels[ctx.channel.id] = CountingState(ctx.channel.id)
+    counting_writer.put(ctx.channel.id, state.row())
     await ctx.send("✅ Channel ini sekarang adalah counting channel! Mulai dari **1**!")
 
 @bot.command()
 async def count(ctx):
     """Lihat angka saat ini di counting channel."""
-    if ctx.channel.id not in counting_channels:
+    state = counting_channels.get(ctx.channel.id)
+    if state is None:
         await ctx.send("❌ Ini bukan counting channel.")
         return
-    await ctx.send(f"📊 Angka saat ini: **{counting_channels[ctx.channel.id]}**")
+    await ctx.send(f"📊 Angka saat ini: **{state.count}** (rekor: **{state.best}**)")
 
-# ================= AFK CHECK IN ON_MESSAGE =================
-@bot.event
-async def on_message(message):
-    if message.author.bot:
+# ================= AUTO REPLY TRIGGERS =================
+TRIGGER_COOLDOWN = float(os.getenv("TRIGGER_COOLDOWN", "10"))  # Seconds before the same trigger fires again
+MAX_TRIGGERS_PER_GUILD = int(os.getenv("MAX_TRIGGERS_PER_GUILD", "200"))
+
+# Built-in replies every guild gets; a guild trigger with the same text overrides them
+DEFAULT_TRIGGERS = {"halo bot": "Halo juga 👋"}
+
+db.execute(
+    "CREATE TABLE IF NOT EXISTS auto_replies ("
+    "guild_id INTEGER NOT NULL, trigger TEXT NOT NULL, response TEXT NOT NULL, "
+    "PRIMARY KEY (guild_id, trigger))"
+)
+trigger_writer = WriteBehind(
+    "INSERT OR REPLACE INTO auto_replies (guild_id, trigger, response) VALUES (?, ?, ?)",
+    "DELETE FROM auto_replies WHERE guild_id = ? AND trigger = ?"
+)
+write_behind_queues.append(trigger_writer)
+
+class AhoCorasick:
+    """Multi-pattern substring matcher.
+
+    One pass over the text finds every pattern, so the cost per message
+    depends on the message length rather than on how many patterns exist.
+    """
+
+    def __init__(self, patterns: list):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = self._goto[node][char] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = child
+            self._out[node] += (index,)
+
+        # Breadth-first so every fail link points at an already finished node
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0) if node else 0
+                self._out[child] += self._out[self._fail[child]]
+
+    def search(self, text: str):
+        """Yield the index of each pattern occurrence, in order of where it ends."""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            yield from out[node]
+
+class TriggerEngine:
+    """Per-guild auto-replies compiled into one automaton, rebuilt only after edits."""
+
+    def __init__(self, cooldown: float):
+        self.cooldown = cooldown
+        self.guilds = {}      # guild_id -> {trigger: response}
+        self._compiled = {}   # guild_id -> (triggers, responses, AhoCorasick)
+        self._last_fired = {}  # (guild_id, trigger) -> monotonic time
+
+    def load(self):
+        for guild_id, trigger, response in db.execute("SELECT guild_id, trigger, response FROM auto_replies"):
+            self.guilds.setdefault(guild_id, {})[trigger] = response
+
+    def set(self, guild_id: int, trigger: str, response: str):
+        self.guilds.setdefault(guild_id, {})[trigger] = response
+        self._compiled.pop(guild_id, None)
+        trigger_writer.put((guild_id, trigger), (guild_id, trigger, response))
+
+    def remove(self, guild_id: int, trigger: str) -> bool:
+        if self.guilds.get(guild_id, {}).pop(trigger, None) is None:
+            return False
+        self._compiled.pop(guild_id, None)
+        self._last_fired.pop((guild_id, trigger), None)
+        trigger_writer.delete((guild_id, trigger))
+        return True
+
+    def _compile(self, guild_id: int):
+        compiled = self._compiled.get(guild_id)
+        if compiled is None:
+            replies = {**DEFAULT_TRIGGERS, **self.guilds.get(guild_id, {})}
+            triggers = list(replies)
+            compiled = self._compiled[guild_id] = (triggers, [replies[t] for t in triggers], AhoCorasick(triggers))
+        return compiled
+
+    def match(self, guild_id: int, content: str):
+        """Response of the first matching trigger that is off cooldown, or None."""
+        triggers, responses, automaton = self._compile(guild_id)
+        now = time.monotonic()
+        for index in automaton.search(content.lower()):
+            key = (guild_id, triggers[index])
+            if now - self._last_fired.get(key, -self.cooldown) < self.cooldown:
+                continue
+            self._last_fired[key] = now
+            return responses[index]
+        return None
+
+trigger_engine = TriggerEngine(TRIGGER_COOLDOWN)
+trigger_engine.load()
+
+@bot.command()
+@commands.has_permissions(manage_guild=True)
+async def addtrigger(ctx, trigger: str, *, response: str):
+    """Tambah auto-reply. Contoh: /addtrigger "selamat pagi" Pagi juga! ☀️"""
+    trigger = trigger.lower().strip()
+    if not trigger or len(trigger) > 100 or len(response) > 500:
+        await ctx.send("❌ Trigger maks 100 karakter, balasan maks 500 karakter.")
         return
-    
-    # XP System - Give XP for messages
-    if not message.content.startswith("/"):
-        user_xp[message.author.id] = user_xp.get(message.author.id, 0) + random.randint(1, 5)
-        
-        # Check for level up
-        old_level = get_level(user_xp[message.author.id] - 5)
-        new_level = get_level(user_xp[message.author.id])
-        if new_level > old_level:
-            await message.channel.send(f"🎉 {message.author.mention} naik ke **Level {new_level}**!")
-    
-    # Counting game check
-    if message.channel.id in counting_channels:
+    current = trigger_engine.guilds.get(ctx.guild.id, {})
+    if trigger not in current and len(current) >= MAX_TRIGGERS_PER_GUILD:
+        await ctx.send(f"❌ Maksimal {MAX_TRIGGERS_PER_GUILD} trigger per server.")
+        return
+    trigger_engine.set(ctx.guild.id, trigger, response)
+    await ctx.send(f"✅ Trigger **{trigger}** disimpan!")
+
+@bot.command()
+@commands.has_permissions(manage_guild=True)
+async def deltrigger(ctx, *, trigger: str):
+    """Hapus auto-reply. Contoh: /deltrigger selamat pagi"""
+    if trigger_engine.remove(ctx.guild.id, trigger.lower().strip()):
+        await ctx.send(f"🗑️ Trigger **{trigger}** dihapus.")
+    else:
+        await ctx.send("❌ Trigger tidak ditemukan.")
+
+@bot.command()
+async def triggers(ctx):
+    """Lihat daftar auto-reply server ini."""
+    current = trigger_engine.guilds.get(ctx.guild.id, {})
+    if not current:
+        await ctx.send("📭 Belum ada trigger. Tambah dengan `/addtrigger \"kata\" balasan`.")
+        return
+    lines = [f"• **{trigger}** → {response[:60]}" for trigger, response in list(current.items())[:25]]
+    embed = discord.Embed(
+        title="💬 Auto Reply Triggers",
+        description="\n".join(lines),
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Total: {len(current)}/{MAX_TRIGGERS_PER_GUILD}")
+    await ctx.send(embed=embed)
+
+# ================= AUTO-MOD =================
+AUTOMOD_FLOOD_COUNT = int(os.getenv("AUTOMOD_FLOOD_COUNT", "6"))          # messages ...
+AUTOMOD_FLOOD_WINDOW = float(os.getenv("AUTOMOD_FLOOD_WINDOW", "5"))       # ... within seconds
+AUTOMOD_DUPLICATE_COUNT = int(os.getenv("AUTOMOD_DUPLICATE_COUNT", "4"))   # identical messages ...
+AUTOMOD_DUPLICATE_WINDOW = float(os.getenv("AUTOMOD_DUPLICATE_WINDOW", "20"))
+AUTOMOD_MENTION_COUNT = int(os.getenv("AUTOMOD_MENTION_COUNT", "8"))       # user/role mentions ...
+AUTOMOD_MENTION_WINDOW = float(os.getenv("AUTOMOD_MENTION_WINDOW", "10"))
+AUTOMOD_IDLE_TTL = float(os.getenv("AUTOMOD_IDLE_TTL", "300"))             # Forget quiet users after this
+AUTOMOD_PURGE_LIMIT = 50
+AUTOMOD_ACTIONS = {
+    "delete": "Hapus pesan pemicu",
+    "purge": "Hapus pesan terbaru pelaku di channel",
+    "kick": "Hapus pesan terbaru pelaku lalu kick",
+}
+
+db.execute(
+    "CREATE TABLE IF NOT EXISTS automod_settings ("
+    "guild_id INTEGER PRIMARY KEY, action TEXT NOT NULL)"
+)
+automod_writer = WriteBehind(
+    "INSERT OR REPLACE INTO automod_settings (guild_id, action) VALUES (?, ?)",
+    "DELETE FROM automod_settings WHERE guild_id = ?"
+)
+write_behind_queues.append(automod_writer)
+
+# Guilds that turned auto-mod on; everyone else skips the stage after one dict lookup
+automod_guilds = {
+    guild_id: action
+    for guild_id, action in db.execute("SELECT guild_id, action FROM automod_settings")
+    if action in AUTOMOD_ACTIONS
+}
+
+class SlidingWindow:
+    """Ring buffer of the last `limit` event times.
+
+    The limit is reached when the buffer is full and its oldest entry is
+    still inside the window; each event is a single O(1) overwrite.
+    """
+
+    __slots__ = ("window", "times", "head")
+
+    def __init__(self, limit: int, window: float):
+        self.window = window
+        self.times = [float("-inf")] * limit
+        self.head = 0  # Index of the oldest entry
+
+    def hit(self, now: float) -> bool:
+        """Record an event; True once `limit` events fall inside the window."""
+        self.times[self.head] = now
+        self.head = (self.head + 1) % len(self.times)
+        return now - self.times[self.head] <= self.window
+
+    def reset(self):
+        self.times = [float("-inf")] * len(self.times)
+
+class SpamTracker:
+    """Recent activity of one user in one channel."""
+
+    __slots__ = ("flood", "duplicates", "mentions", "last_hash", "last_seen")
+
+    def __init__(self):
+        self.flood = SlidingWindow(AUTOMOD_FLOOD_COUNT, AUTOMOD_FLOOD_WINDOW)
+        self.duplicates = SlidingWindow(AUTOMOD_DUPLICATE_COUNT, AUTOMOD_DUPLICATE_WINDOW)
+        self.mentions = SlidingWindow(AUTOMOD_MENTION_COUNT, AUTOMOD_MENTION_WINDOW)
+        self.last_hash = None
+        self.last_seen = 0.0
+
+    def check(self, message, now: float):
+        """Name of the rule this message breaks, or None."""
+        self.last_seen = now
+        violation = None
+        if self.flood.hit(now):
+            violation = "flood"
+
+        # Attachment-only posts have no text to compare, so they never count as duplicates
+        text = message.content.strip().lower()
+        stickers = tuple(sticker.id for sticker in message.stickers)
+        if text or stickers:
+            content_hash = hash((text, stickers))
+            if content_hash != self.last_hash:
+                self.last_hash = content_hash
+                self.duplicates.reset()
+            if self.duplicates.hit(now):
+                violation = "duplicate"
+        mention_count = min(len(message.raw_mentions) + len(message.raw_role_mentions), AUTOMOD_MENTION_COUNT)
+        for _ in range(mention_count):
+            if self.mentions.hit(now):
+                violation = "mention"
+        return violation
+
+class AutoMod:
+    """Per (guild, channel, user) spam trackers, evicted once idle so memory stays bounded."""
+
+    def __init__(self, idle_ttl: float):
+        self.idle_ttl = idle_ttl
+        self._trackers = OrderedDict()  # (guild_id, channel_id, user_id) -> SpamTracker, oldest first
+
+    def check(self, message):
+        now = time.monotonic()
+        key = (message.guild.id, message.channel.id, message.author.id)
+        tracker = self._trackers.pop(key, None)
+
+        # Trackers are ordered by last use, so idle ones sit at the front
+        while self._trackers:
+            oldest_key, oldest = next(iter(self._trackers.items()))
+            if now - oldest.last_seen <= self.idle_ttl:
+                break
+            del self._trackers[oldest_key]
+
+        if tracker is None:
+            tracker = SpamTracker()
+        self._trackers[key] = tracker
+
+        violation = tracker.check(message, now)
+        if violation:
+            del self._trackers[key]  # Start clean so one burst triggers one action
+        return violation
+
+    def __len__(self):
+        return len(self._trackers)
+
+automod = AutoMod(AUTOMOD_IDLE_TTL)
+
+AUTOMOD_REASONS = {
+    "flood": "mengirim pesan terlalu cepat",
+    "duplicate": "mengirim pesan yang sama berulang kali",
+    "mention": "mention terlalu banyak",
+}
+
+async def automod_act(message, violation: str, action: str):
+    reason = f"Auto-mod: {AUTOMOD_REASONS[violation]}"
+    author = message.author
+    if action == "delete":
         try:
-            num = int(message.content)
-            expected = counting_channels[message.channel.id] + 1
-            if num == expected:
-                counting_channels[message.channel.id] = num
-                await message.add_reaction("✅")
-                # Bonus XP for counting
-                user_xp[message.author.id] = user_xp.get(message.author.id, 0) + 2
-            else:
-                await message.add_reaction("❌")
-                await message.channel.send(f"❌ {message.author.mention} salah! Angka seharusnya **{expected}**. Mulai ulang dari **1**!")
-                counting_channels[message.channel.id] = 0
-        except ValueError:
-            pass  # Not a number, ignore
-    
+            await message.delete()
+        except discord.NotFound:
+            pass
+    else:
+        await purge_messages(message.channel, AUTOMOD_PURGE_LIMIT, check=lambda m: m.author.id == author.id)
+    if action == "kick":
+        await kick_member(author, reason)
+        await message.channel.send(f"👢 {author.mention} telah di-kick.\nAlasan: {reason}")
+    else:
+        await message.channel.send(f"⚠️ {author.mention} diperingatkan.\nAlasan: {reason}", delete_after=10)
+
+@bot.command(name="automod")
+@commands.has_permissions(manage_guild=True)
+async def automod_cmd(ctx, action: str = None):
+    """Atur auto-mod. Contoh: /automod purge, /automod off"""
+    if action is None:
+        current = automod_guilds.get(ctx.guild.id)
+        status = f"✅ Aktif — aksi **{current}**" if current else "❌ Nonaktif"
+        options = "\n".join(f"`{name}` - {desc}" for name, desc in AUTOMOD_ACTIONS.items())
+        await ctx.send(f"🛡️ **Auto-mod:** {status}\n\n{options}\n`off` - Matikan auto-mod")
+        return
+
+    action = action.lower()
+    if action == "off":
+        automod_guilds.pop(ctx.guild.id, None)
+        automod_writer.delete(ctx.guild.id)
+        await ctx.send("🛡️ Auto-mod dimatikan.")
+        return
+    if action not in AUTOMOD_ACTIONS:
+        await ctx.send(f"❌ Aksi tidak valid. Pilih: {', '.join(AUTOMOD_ACTIONS)}, off")
+        return
+
+    automod_guilds[ctx.guild.id] = action
+    automod_writer.put(ctx.guild.id, (ctx.guild.id, action))
+    await ctx.send(f"🛡️ Auto-mod aktif dengan aksi **{action}**.")
+
+# ================= MESSAGE STAGES =================
+@message_pipeline.stage("automod", order=5)
+async def automod_stage(message, defer):
+    if message.guild is None:
+        return
+    action = automod_guilds.get(message.guild.id)
+    if action is None or message.author.guild_permissions.manage_messages:
+        return
+    violation = automod.check(message)
+    if violation is None:
+        return
+    defer(automod_act(message, violation, action))
+    return True  # Spam earns no XP and runs no commands
+
+@message_pipeline.stage("xp", order=10)
+async def xp_stage(message, defer):
+    if message.content.startswith("/"):
+        return
+    gained = random.randint(1, 5)
+    xp = await add_xp(message.guild.id if message.guild else 0, message.author.id, gained)
+    
+    # Check for level up
+    old_level = get_level(xp - gained)
+    new_level = get_level(xp)
+    if new_level > old_level:
+        defer(message.channel.send(f"🎉 {message.author.mention} naik ke **Level {new_level}**!"))
+
+# Runs before any stage that awaits, so counts are decided in gateway order
+@message_pipeline.stage("counting", order=8)
+async def counting_stage(message, defer):
+    state = counting_channels.get(message.channel.id)
+    if state is None:
+        return
+    try:
+        num = int(message.content)
+    except ValueError:
+        return  # Not a number, ignore
+
+    expected = state.count + 1
+    broke = state.advance(message.author.id, num)
+    if broke is None:
+        counting_reactions.add(message, "✅")
+        # Bonus XP for counting
+        defer(add_xp(message.guild.id if message.guild else 0, message.author.id, 2))
+    elif broke == "twice":
+        counting_reactions.add(message, "❌")
+        defer(message.channel.send(f"❌ {message.author.mention} tidak boleh menghitung dua kali berturut-turut! Mulai ulang dari **1**!"))
+    else:
+        counting_reactions.add(message, "❌")
+        defer(message.channel.send(f"❌ {message.author.mention} salah! Angka seharusnya **{expected}**. Mulai ulang dari **1**!"))
+
+@message_pipeline.stage("afk", order=30)
+async def afk_stage(message, defer):
+    lines = []
+
     # Check if user is back from AFK
-    if message.author.id in afk_users:
-        afk_data = afk_users.pop(message.author.id)
-        afk_time = datetime.datetime.now() - afk_data["time"]
-        minutes = int(afk_time.total_seconds() // 60)
-        await message.channel.send(f"👋 Welcome back {message.author.mention}! Kamu AFK selama **{minutes} menit**.")
+    status = afk_registry.pop(message.author.id)
+    if status is not None:
+        minutes = int((time.time() - status[1]) // 60)
+        lines.append(f"👋 Welcome back {message.author.mention}! Kamu AFK selama **{minutes} menit**.")
     
-    # Check if mentioned user is AFK
+    # Check if mentioned users are AFK, one reply for all of them
     for mentioned in message.mentions:
-        if mentioned.id in afk_users:
-            afk_data = afk_users[mentioned.id]
-            await message.channel.send(f"💤 {mentioned.display_name} sedang AFK: **{afk_data['reason']}**")
-    
-    # Auto reply halo bot
-    if "halo bot" in message.content.lower():
-        await message.channel.send("Halo juga 👋")
-    
-    await bot.process_commands(message)
+        status = afk_registry.get(mentioned.id)
+        if status is not None and afk_registry.should_notify(message.channel.id, mentioned.id):
+            lines.append(f"💤 {mentioned.display_name} sedang AFK: **{status[0]}**")
+
+    if lines:
+        defer(message.channel.send("\n".join(lines)))
+
+@message_pipeline.stage("auto_reply", order=40)
+async def auto_reply_stage(message, defer):
+    response = trigger_engine.match(message.guild.id if message.guild else 0, message.content)
+    if response is not None:
+        defer(message.channel.send(response))
+
+@message_pipeline.stage("commands", order=100)
+async def commands_stage(message, defer):
+    # Commands can run for a long time (AI), so they go alongside the other side effects
+    defer(bot.process_commands(message))
+
+@bot.command()
+@commands.is_owner()
+async def msgstats(ctx):
+    """Latency per stage of the message pipeline (owner only)"""
+    if not message_pipeline.stats:
+        await ctx.send("📭 Belum ada pesan yang diproses.")
+        return
+
+    lines = [f"{'stage':<22}{'calls':>8}{'avg ms':>9}{'max ms':>9}"]
+    for name, (calls, total, worst) in message_pipeline.stats.items():
+        lines.append(f"{name:<22}{calls:>8}{total / calls * 1000:>9.2f}{worst * 1000:>9.1f}")
+    await ctx.send("⏱️ **Message Pipeline**\n```\n" + "\n".join(lines) + "\n```")
 
 # ================= ERROR HANDLER =================
 @kick.error
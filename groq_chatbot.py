@@ -1,11 +1,12 @@
 import os
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from groq import Groq
 from dotenv import load_dotenv
 from datetime import datetime
 import asyncio
 import random
+from ai_scheduler import AIBusyError, FairScheduler, RateLimited, RateLimiter, parse_weights
 
 # ================= LOAD ENV =================
 load_dotenv()
@@ -51,12 +52,36 @@ SYSTEM_PROMPTS = {
 }
 current_persona = "default"
 
+# ================= RATE LIMITING =================
+ai_limiter = RateLimiter(
+    user_rate=float(os.getenv("AI_USER_REFILL", "0.1")),
+    user_burst=float(os.getenv("AI_USER_BURST", "3")),
+    guild_rate=float(os.getenv("AI_GUILD_REFILL", "1.0")),
+    guild_burst=float(os.getenv("AI_GUILD_BURST", "20"))
+)
+ai_scheduler = FairScheduler(
+    max_concurrency=int(os.getenv("AI_MAX_CONCURRENCY", "4")),
+    max_queue=int(os.getenv("AI_MAX_QUEUE", "20")),
+    timeout=float(os.getenv("AI_TIMEOUT", "60")),
+    weights=parse_weights(os.getenv("AI_GUILD_WEIGHTS", ""))
+)
+
+@tasks.loop(seconds=60)
+async def prune_rate_limits():
+    # Drop buckets and fairness state for users/guilds that went quiet
+    ai_limiter.prune()
+    ai_scheduler.prune()
+
 # ================= DISCORD BOT =================
 intents = discord.Intents.default()
 intents.message_content = True
 
 bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
 
+@bot.event
+async def setup_hook():
+    prune_rate_limits.start()
+
 # ================= HELPER FUNCTIONS =================
 def get_user_history(user_id):
     """Get or create conversation history for a user."""
@@ -77,7 +102,7 @@ def clear_history(user_id):
     if user_id in conversation_history:
         conversation_history[user_id] = []
 
-async def get_ai_response(user_id, prompt, system_override=None):
+def get_ai_response(user_id, prompt, system_override=None):
     """Get AI response from Groq with conversation history."""
     history = get_user_history(user_id)
     
@@ -136,14 +161,22 @@ async def on_message(message):
     if message.content.startswith("!"):
         return
     
+    # Rate limit per user & guild
+    guild_id = message.guild.id if message.guild else 0
+    try:
+        ai_limiter.check(message.author.id, guild_id)
+    except RateLimited as e:
+        await message.reply(f"🐢 Terlalu cepat! Coba lagi dalam **{e.retry_after:.1f} detik**.", mention_author=False)
+        return
+    
     # AI Chat
     async with message.channel.typing():
         try:
             user_id = str(message.author.id)
             
-            # Get AI response
-            response = await asyncio.to_thread(
-                get_ai_response, user_id, message.content
+            # Get AI response (fair-queued across guilds)
+            response = await ai_scheduler.run_blocking(
+                guild_id, get_ai_response, user_id, message.content
             )
             
             # Parse response
@@ -174,6 +207,8 @@ async def on_message(message):
             if len(ai_text) > 4000:
                 await message.channel.send(ai_text[4000:])
                 
+        except AIBusyError:
+            await message.reply("⏳ AI sedang sibuk, coba lagi sebentar lagi.", mention_author=False)
         except Exception as e:
             print(f"Error: {e}")
             await message.reply(f"❌ Error: {str(e)[:200]}", mention_author=False)